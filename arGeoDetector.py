@@ -15,12 +15,27 @@ import re
 import time
 import datetime
 import threading
+import asyncio
+import socket
+import selectors
+import bisect
+import queue
+import gzip
+import shutil
 from threading import Thread
+from array import array
+from itertools import islice
+from collections import namedtuple, deque, OrderedDict
+import traceback
 #import io
 import logging
 import logging.handlers
 import serial
 import xml.etree.ElementTree
+import hashlib
+import mmap
+import pickle
+import struct
 import wx
 import wx.html
 import winsound
@@ -34,6 +49,12 @@ elif os.name == 'posix':
 
 from enum import Enum
 
+# NumPy is optional, used for the vectorized point in polygon kernel
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from appdirs import AppDirs 
 from optparse import OptionParser
 from configparser import ConfigParser
@@ -41,6 +62,13 @@ from configparser import ConfigParser
 
 VERSION = "0.3.3"
 
+# Precompiled boundary cache file format
+CACHE_MAGIC = b"AGDC"
+CACHE_VERSION = 6
+CACHE_PREFIX_LEN = 12 # hex digits of the source path hash in cache names
+RASTER_MAGIC = b"AGDR"
+RASTER_HEADER = 64
+
 # Courtesy of Chris Liechti <cliechti@gmx.net> (C) 2001-2015 
 from wxSerialConfigDialog import SerialConfigDialog
 
@@ -53,19 +81,266 @@ class geoMsg(Enum):
     NOTIF = 6
     POPUP = 7
     REPLAY= 8
+    NEXT  = 9 # (GRID or CNTY, distance m, eta s, next name) ahead on course
+
+# Below this many edges the plain Python loop beats the NumPy call overhead
+VECTOR_MIN_EDGES = 384
+
+# Crossing prediction range and minimum speed
+PREDICT_RANGE_M = 30000
+PREDICT_MIN_KNOTS = 2.0
+# Planned route chunk length and clearance corridor
+ROUTE_CHUNK_M = 100
+ROUTE_CORRIDOR_M = 200
+# Serial receive buffer limit without a line ending, NMEA lines are <= 82
+RX_BUF_MAX = 4096
+# Network input read size and longest reconnect wait in seconds
+NET_READ_SIZE = 65536
+NET_RETRY_MAX = 30
+# Asks gpsd to stream the receiver's NMEA sentences
+GPSD_WATCH = b'?WATCH={"enable":true,"nmea":true}\n'
+RETRY_MIN = 0.25
+# Event bus queue length per subscriber and delivery delay counted as lag
+BUS_QUEUE_LEN = 256
+BUS_LAG_S = 0.5
+# GUI refresh period in milliseconds
+GUI_REFRESH_MS = 200
+
+# NMEA session log segments, closed segments are gzipped
+NMEA_LOG_MAX_BYTES = 16*1024*1024
+NMEA_LOG_MAX_AGE_S = 24*3600
+NMEA_LOG_BACKUPS = 20
+NMEA_LOG_COMPRESS = True
+NMEA_LOG_BUFFER = 256*1024
+NMEA_LOG_FLUSH_S = 5
+# Meters per degree of latitude
+DEG_M = 111320
+
+# Result cache radius bounds, the edge search looks no further than
+# SAFE_RADIUS_M and a radius below SAFE_MIN_M is not cached
+SAFE_RADIUS_M = 1000
+SAFE_MIN_M = 5
+
+# Cell labels used by geoCellMap, real boundary ids are >= 0
+CELL_UNSET = -3
+CELL_EDGE = -2
+CELL_UNKNOWN = -1
+# Padding used when marking cells touched by an edge, in degrees
+CELL_EPS = 1e-9
+# Position inside a cell used to classify it
+CELL_SAMPLE = (0.4142135623730951, 0.3819660112501051)
+
+# Parsed NMEA sentences, fields are kept as the raw strings
+geoNmeaRMC = namedtuple("geoNmeaRMC", "talker time status lat lat_d lon lon_d knots course date")
+geoNmeaGGA = namedtuple("geoNmeaGGA", "talker time lat lat_d lon lon_d quality")
+
+class geoNmea():
+    # Single pass NMEA 0183 parser.  A line is checksum validated, split
+    # once and handed to the record builder for its sentence ID.  Any
+    # supported talker is accepted, multi-constellation receivers send
+    # $GNGGA rather than $GPGGA.  A line without its checksum is rejected
+    # unless strict is off, a line cut short at a field boundary would
+    # otherwise parse as a valid fix.
+    TALKERS = ("GP", "GN", "GL", "GA", "GB")
+    PARSERS = {
+        "RMC": lambda talker, f: geoNmeaRMC(talker, *f[1:10]) if len(f) >= 10 else None,
+        "GGA": lambda talker, f: geoNmeaGGA(talker, *f[1:7]) if len(f) >= 7 else None,
+    }
+    
+    @staticmethod
+    def checksum(body):
+        cs = 0
+        for c in body.encode():
+            cs ^= c
+        return cs
+    
+    @staticmethod
+    def frame(buf, lines):
+        # Move the complete lines in the bytearray buf onto lines, decoded
+        # and stripped, slicing through a memoryview so nothing is copied
+        # before decoding.  JSON reports gpsd sends between the sentences
+        # are skipped.  Returns the number of undecodable lines dropped.
+        end = buf.rfind(b'\n') + 1
+        if not end:
+            if len(buf) > RX_BUF_MAX:
+                buf.clear()
+            return 0
+        bad = 0
+        with memoryview(buf) as mv:
+            start = 0
+            while start < end:
+                nl = buf.index(b'\n', start, end)
+                try:
+                    line = str(mv[start:nl], 'ascii').rstrip()
+                    if line and line[0] != '{':
+                        lines.append(line)
+                except UnicodeDecodeError:
+                    bad += 1
+                start = nl + 1
+        del buf[:end]
+        return bad
+    
+    @staticmethod
+    def parseLogged(line, source=None):
+        # parse() for a line of the NMEA log, where sentences of receivers
+        # other than the primary one are tagged "[source] ".  Only lines of
+        # source (None for the untagged ones) give a record.
+        if line[:1] == '[':
+            (tag, sep, line) = line[1:].partition('] ')
+            if not sep or tag != source:
+                return None
+        elif source is not None:
+            return None
+        return geoNmea.parse(line)
+    
+    @staticmethod
+    def parse(line, strict=True):
+        # Returns a record or None for unsupported or corrupt sentences
+        line = line.strip()
+        if line[:1] != '$':
+            return None
+        (body, star, cs) = line[1:].partition('*')
+        talker = body[:2]
+        if talker not in geoNmea.TALKERS:
+            return None
+        parser = geoNmea.PARSERS.get(body[2:5])
+        if parser is None or body[5:6] != ',':
+            return None
+        if star:
+            try:
+                if len(cs) < 2 or int(cs[:2], 16) != geoNmea.checksum(body):
+                    return None
+            except ValueError:
+                return None
+        elif strict:
+            return None
+        return parser(talker, body.split(','))
 
 class geoBoundary():
+    # Vertices and edge tables are kept in flat arrays of doubles rather
+    # than lists of tuples, the boundary files can hold millions of points
+    __slots__ = ("id", "name", "abbr", "xs", "ys", "ms", "bs", "minx", "miny", "maxx", "maxy",
+                 "simple", "band", "kx", "spans")
+    
     def __init__(self, name, abbr):
+        self.id = -1 # position in the detector boundary list
         self.name = name
         self.abbr = abbr
-        self.coords = []
+        self.xs = array('d')
+        self.ys = array('d')
+        
+        # bounding box and per edge line equations, filled in by wrapCoord()
+        self.minx = self.miny = math.inf
+        self.maxx = self.maxy = -math.inf
+        self.ms = array('d')
+        self.bs = array('d')
+        self.spans = None # NumPy (low x, high x) of every edge, see buildSpans()
+        
+        # optional simplified outline, exact outside band, see simplify()
+        self.simple = None
+        self.band = 0.0
+        self.kx = 1.0
         
     def addCoord(self, xy):
         # xy is a (x,y) tuple
-        self.coords.append(xy)
+        self.xs.append(xy[0])
+        self.ys.append(xy[1])
     
     def wrapCoord(self):
-        self.coords.append(self.coords[0])
+        self.xs.append(self.xs[0])
+        self.ys.append(self.ys[0])
+        self.buildTables()
+    
+    def firstCoord(self):
+        return (self.xs[0], self.ys[0])
+    
+    def edges(self):
+        # iterate (x1,y1,x2,y2,m,b) for every edge without copying
+        return zip(self.xs, self.ys, islice(self.xs, 1, None), islice(self.ys, 1, None), self.ms, self.bs)
+    
+    def buildTables(self):
+        # Precompute bounding box and line equation of every edge so
+        # contains() does not need to solve them on every fix
+        self.minx = min(self.xs)
+        self.maxx = max(self.xs)
+        self.miny = min(self.ys)
+        self.maxy = max(self.ys)
+        
+        self.ms = array('d')
+        self.bs = array('d')
+        for (cx1,cy1,cx2,cy2) in zip(self.xs, self.ys, islice(self.xs, 1, None), islice(self.ys, 1, None)):
+            if cx1 == cx2:
+                # vertical edge, never solved for y
+                (m,b) = (0.0, 0.0)
+            else:
+                (m,b) = self.coords2mxb((cx1,cy1),(cx2,cy2))
+            self.ms.append(m)
+            self.bs.append(b)
+        self.buildSpans()
+    
+    def buildSpans(self):
+        # x range of every edge, the NumPy kernel only evaluates the edges
+        # whose range holds the fix
+        if np is None or len(self.ms) < VECTOR_MIN_EDGES:
+            self.spans = None
+            return
+        xs = np.frombuffer(self.xs)
+        self.spans = (np.minimum(xs[:-1], xs[1:]), np.maximum(xs[:-1], xs[1:]))
+    
+    def memoryUsage(self):
+        used = sum(len(a) * a.itemsize for a in (self.xs, self.ys, self.ms, self.bs))
+        if self.spans is not None:
+            used += sum(a.nbytes for a in self.spans)
+        if self.simple is not None:
+            used += self.simple.memoryUsage()
+        return used
+    
+    def simplify(self, tol):
+        # Douglas-Peucker with tol in degrees of latitude, longitude scaled
+        # by kx.  band is the largest distance of any dropped vertex from
+        # its replacement segment, so every original edge lies within band
+        # of the simplified outline.
+        self.simple = None
+        n = len(self.xs)
+        self.kx = kx = math.cos(math.radians((self.miny + self.maxy) / 2))
+        keep = bytearray(n)
+        keep[0] = keep[n-1] = 1
+        band = 0.0
+        stack = [(0, n-1)]
+        while stack:
+            (a, b) = stack.pop()
+            if b <= a + 1:
+                continue
+            # farthest vertex from the segment a-b
+            (ax, ay) = (self.xs[a], self.ys[a])
+            ex = (self.xs[b] - ax) * kx
+            ey = self.ys[b] - ay
+            ll = ex*ex + ey*ey
+            (dmax, imax) = (-1.0, a)
+            for i in range(a + 1, b):
+                px = (self.xs[i] - ax) * kx
+                py = self.ys[i] - ay
+                t = min(1.0, max(0.0, (px*ex + py*ey) / ll)) if ll > 0 else 0.0
+                d = math.hypot(px - t*ex, py - t*ey)
+                if d > dmax:
+                    (dmax, imax) = (d, i)
+            if dmax > tol:
+                keep[imax] = 1
+                stack.append((a, imax))
+                stack.append((imax, b))
+            else:
+                band = max(band, dmax)
+        
+        # not worth a second outline unless it is much smaller
+        kept = sum(keep)
+        if kept > n // 2:
+            return
+        simple = geoBoundary(self.name, self.abbr)
+        simple.xs = array('d', (v for (v,k) in zip(self.xs, keep) if k))
+        simple.ys = array('d', (v for (v,k) in zip(self.ys, keep) if k))
+        simple.buildTables()
+        self.simple = simple
+        self.band = band + CELL_EPS
     
     def coords2mxb(self, c1,c2):
         # solve for line equation
@@ -78,15 +353,57 @@ class geoBoundary():
         return (m,b)
       
     def contains(self, xy):
+        return geoBoundary.containsMany(xy, [self])[0]
+    
+    def containsSimple(self, xy):
+        # Answer from the simplified outline when the point is further from
+        # it than the error band, the full outline can not differ there.
+        # None means the full test is needed.
+        if self.simple is None:
+            return None
+        return self.simple.containsBand(xy, self.kx, self.band)
+    
+    def containsBand(self, xy, kx, band):
+        # containsLoop() that gives up with None as soon as xy is within band
+        # of an edge.  Edges more than band away in x are skipped without
+        # computing a distance, they can not span x either.
+        (x,y) = xy
+        bx = band / kx
+        test_cnt = 0
+        coord_cnt = 0
+        for (cx1,cy1,cx2,cy2,m,b) in self.edges():
+            if (x < cx1 - bx and x < cx2 - bx) or (x > cx1 + bx and x > cx2 + bx):
+                continue
+            
+            ex = (cx2 - cx1) * kx
+            ey = cy2 - cy1
+            px = (x - cx1) * kx
+            py = y - cy1
+            ll = ex*ex + ey*ey
+            t = min(1.0, max(0.0, (px*ex + py*ey) / ll)) if ll > 0 else 0.0
+            if math.hypot(px - t*ex, py - t*ey) <= band:
+                return None
+            
+            if x == cx1:
+                above = cy1 >= y
+            elif x == cx2:
+                above = cy2 >= y
+            elif x >= cx1 and x <= cx2 or x >= cx2 and x <= cx1:
+                above = m*x+b >= y
+            else:
+                continue
+            test_cnt += 1 if above else -1
+            coord_cnt += 1
+        return (coord_cnt - abs(test_cnt)) % 4 != 0
+    
+    def containsLoop(self, xy):
         (x,y) = xy
 
         test_cnt = 0
         coord_cnt = 0
 
-        for i in range(len(self.coords)-1):
+        for (cx1,cy1,cx2,cy2,m,b) in self.edges():
             # Test against sequential coordinates
-            (cx1,cy1) = self.coords[i]
-            (cx2,cy2) = self.coords[i+1]
             # the NMEA X coordinate must fall between the two test coords
             if x == cx1:
                 if cy1 < y:
@@ -103,9 +420,7 @@ class geoBoundary():
                 coord_cnt +=1
                 
             elif x >= cx1 and x <= cx2 or x >= cx2 and x <= cx1:
-                # Solve for line equation y=mx+b
-                (m,b) = self.coords2mxb(self.coords[i],self.coords[i+1])
-                # Calculate Y coordinate from equation
+                # Calculate Y coordinate from precomputed y=mx+b
                 ycalc = m*x+b
                 
                 # Compare calculated Y vs NMEA Y
@@ -124,19 +439,749 @@ class geoBoundary():
         else:
             return False
     
+    @staticmethod
+    def containsMany(xy, bnds):
+        # Test one point against several boundaries, large boundaries go
+        # through the NumPy kernel, same rules as contains()
+        (x,y) = xy
+        res = [False] * len(bnds)
+        
+        # nothing outside the bounding box can be inside the boundary
+        hits = []
+        for (i,b) in enumerate(bnds):
+            if b.minx <= x <= b.maxx and b.miny <= y <= b.maxy:
+                inside = b.containsSimple(xy)
+                if inside is None:
+                    hits.append(i)
+                else:
+                    res[i] = inside
+        
+        for i in hits:
+            if bnds[i].spans is None:
+                res[i] = bnds[i].containsLoop(xy)
+            else:
+                res[i] = bnds[i].containsVector(xy)
+        return res
+    
+    def containsVector(self, xy):
+        # NumPy contains() over the edges spanning x only, every other edge
+        # neither starts, ends nor crosses at x
+        (x,y) = xy
+        (lo, hi) = self.spans
+        k = np.flatnonzero((lo <= x) & (hi >= x))
+        if not len(k):
+            return False
+        xs = np.frombuffer(self.xs)
+        ys = np.frombuffer(self.ys)
+        (hit, above) = geoBoundary.edgeTests(x, y, xs[k], ys[k], xs[k+1], ys[k+1],
+                                             np.frombuffer(self.ms)[k], np.frombuffer(self.bs)[k])
+        coord_cnt = int(np.count_nonzero(hit))
+        test_cnt = 2 * int(np.count_nonzero(above)) - coord_cnt
+        return (coord_cnt - abs(test_cnt)) % 4 != 0
+    
+    def containsPoints(self, px, py):
+        # Test an array of points against this boundary, returns a bool
+        # array.  Points are processed in chunks to bound the temporaries.
+        res = np.zeros(len(px), dtype=bool)
+        sel = np.nonzero((px >= self.minx) & (px <= self.maxx) & (py >= self.miny) & (py <= self.maxy))[0]
+        if not len(sel) or not len(self.ms):
+            return res
+        
+        xs = np.frombuffer(self.xs)
+        ys = np.frombuffer(self.ys)
+        edges = (xs[:-1], ys[:-1], xs[1:], ys[1:], np.frombuffer(self.ms), np.frombuffer(self.bs))
+        chunk = max(1, (1 << 20) // len(self.ms))
+        for i in range(0, len(sel), chunk):
+            k = sel[i:i+chunk]
+            (hit, above) = geoBoundary.edgeTests(px[k,None], py[k,None], *edges)
+            coord_cnt = hit.sum(axis=1)
+            test_cnt = 2 * above.sum(axis=1) - coord_cnt
+            res[k] = (coord_cnt - np.abs(test_cnt)) % 4 != 0
+        return res
+    
+    @staticmethod
+    def edgeTests(x, y, x1, y1, x2, y2, m, b):
+        # Vectorized form of the per edge rules in contains(), returns which
+        # edges span x and which of those lie on or above y
+        on1 = x1 == x
+        on2 = ~on1 & (x2 == x)
+        span = ~on1 & ~on2 & (((x >= x1) & (x <= x2)) | ((x >= x2) & (x <= x1)))
+        above = (on1 & (y1 >= y)) | (on2 & (y2 >= y)) | (span & (m*x+b >= y))
+        return (on1 | on2 | span, above)
+    
+class geoIndex():
+    # Common parts of the boundary lookup engines.  An index is not changed
+    # after it is built, detectors sharing it keep their own query timing.
+    engine = ""
+    
+    def __init__(self):
+        self.build_time = 0.0
+    
+    def query(self, xy):
+        return self._query(xy)
+    
+    def attach(self, boundaries):
+        # Bind an index restored from the boundary cache to its boundaries
+        self.boundaries = boundaries
+    
+    def getState(self):
+        # plain data for the boundary cache, boundaries are stored by id
+        state = dict(self.__dict__, engine=self.engine)
+        state.pop("boundaries", None)
+        return state
+    
+    @staticmethod
+    def fromState(state, boundaries):
+        cls = {"grid": geoGridIndex, "rtree": geoRTreeIndex}[state["engine"]]
+        index = cls.__new__(cls)
+        index.__dict__.update(state)
+        index.attach(boundaries)
+        return index
+    
+    def report(self, queries, query_time):
+        avg = query_time / queries * 1e6 if queries else 0
+        return "Index [%s] build %.1f ms, %d queries avg %.1f us" % (self.engine, self.build_time * 1e3, queries, avg)
+
+class geoGridIndex(geoIndex):
+    # Uniform lat/lon grid of buckets, each bucket lists the boundaries
+    # whose bounding box overlaps the cell
+    engine = "grid"
+    
+    def __init__(self, boundaries, cell=0.1):
+        geoIndex.__init__(self)
+        t = time.perf_counter()
+        self.cell = cell
+        self.buckets = {}
+        
+        for bnd in boundaries:
+            for ix in range(math.floor(bnd.minx / cell), math.floor(bnd.maxx / cell) + 1):
+                for iy in range(math.floor(bnd.miny / cell), math.floor(bnd.maxy / cell) + 1):
+                    self.buckets.setdefault((ix,iy), []).append(bnd)
+        self.build_time = time.perf_counter() - t
+    
+    def getState(self):
+        state = geoIndex.getState(self)
+        state["buckets"] = {k: [b.id for b in v] for (k,v) in self.buckets.items()}
+        return state
+    
+    def attach(self, boundaries):
+        geoIndex.attach(self, boundaries)
+        self.buckets = {k: [boundaries[i] for i in v] for (k,v) in self.buckets.items()}
+    
+    def _query(self, xy):
+        (x,y) = xy
+        return self.buckets.get((math.floor(x / self.cell), math.floor(y / self.cell)), ())
+
+class geoRTreeIndex(geoIndex):
+    # Sort-Tile-Recursive packed R-tree over boundary bounding boxes.
+    # Nodes live in flat arrays, level by level from the leaves up with
+    # the root last.  Entries below self.nleaf are boundaries, every other
+    # entry covers node_first[i] .. node_first[i]+node_count[i]-1.
+    engine = "rtree"
+    
+    def __init__(self, boundaries, fanout=8):
+        geoIndex.__init__(self)
+        t = time.perf_counter()
+        self.boundaries = boundaries
+        self.minx = array('d')
+        self.miny = array('d')
+        self.maxx = array('d')
+        self.maxy = array('d')
+        self.node_first = array('i')
+        self.node_count = array('i')
+        self.root = -1
+        
+        # level entries are (minx, miny, maxx, maxy, first, count), for
+        # leaves first holds the position in the boundary list
+        level = [(b.minx, b.miny, b.maxx, b.maxy, i, 0) for (i,b) in enumerate(boundaries)]
+        self.nleaf = len(level)
+        base = 0
+        while level:
+            level = self.strSort(level, fanout)
+            for e in level:
+                self.minx.append(e[0])
+                self.miny.append(e[1])
+                self.maxx.append(e[2])
+                self.maxy.append(e[3])
+                self.node_first.append(e[4])
+                self.node_count.append(e[5])
+            if len(level) == 1:
+                break
+            
+            # pack consecutive runs of entries into parent nodes
+            parents = []
+            for i in range(0, len(level), fanout):
+                group = level[i:i+fanout]
+                parents.append((min(e[0] for e in group), min(e[1] for e in group),
+                                max(e[2] for e in group), max(e[3] for e in group),
+                                base + i, len(group)))
+            base += len(level)
+            level = parents
+        self.root = len(self.minx) - 1
+        self.build_time = time.perf_counter() - t
+    
+    def strSort(self, level, fanout):
+        # order entries by x center in vertical slices, then by y center
+        # within each slice so runs of fanout entries are spatially tight
+        pages = math.ceil(len(level) / fanout)
+        slice_len = math.ceil(math.sqrt(pages)) * fanout
+        level = sorted(level, key=lambda e: e[0] + e[2])
+        res = []
+        for i in range(0, len(level), slice_len):
+            res.extend(sorted(level[i:i+slice_len], key=lambda e: e[1] + e[3]))
+        return res
+    
+    def _query(self, xy):
+        (x,y) = xy
+        hits = []
+        if self.root < 0:
+            return hits
+        
+        stack = [self.root]
+        while stack:
+            n = stack.pop()
+            if x < self.minx[n] or x > self.maxx[n] or y < self.miny[n] or y > self.maxy[n]:
+                continue
+            if n < self.nleaf:
+                hits.append(self.node_first[n])
+            else:
+                first = self.node_first[n]
+                stack.extend(range(first, first + self.node_count[n]))
+        
+        # keep boundary file order so overlap resolution matches the other engines
+        hits.sort()
+        return [self.boundaries[i] for i in hits]
+
+class geoCellMap():
+    # Regular lat/lon lattice over the loaded boundaries.  Cells touched by
+    # any boundary edge are marked CELL_EDGE, every other cell holds the id
+    # of the boundary findCAIC returns anywhere inside it (CELL_UNKNOWN when
+    # no boundary matches).  Neighbouring cells without edges can not be
+    # separated by a line so each connected region is classified once.
+    def __init__(self, x0, y0, dx, dy, nx, ny):
+        self.x0 = x0
+        self.y0 = y0
+        self.dx = dx
+        self.dy = dy
+        self.nx = nx
+        self.ny = ny
+        self.cells = None
+    
+    @staticmethod
+    def covering(boundaries, dx, dy, x0=None, y0=None):
+        # Lattice covering all boundaries, optionally snapped to an origin
+        minx = min(b.minx for b in boundaries)
+        miny = min(b.miny for b in boundaries)
+        maxx = max(b.maxx for b in boundaries)
+        maxy = max(b.maxy for b in boundaries)
+        if x0 is None:
+            (x0, y0) = (minx, miny)
+        ix0 = math.floor((minx - x0) / dx) - 1
+        iy0 = math.floor((miny - y0) / dy) - 1
+        nx = math.floor((maxx - x0) / dx) + 2 - ix0
+        ny = math.floor((maxy - y0) / dy) + 2 - iy0
+        return geoCellMap(x0 + ix0*dx, y0 + iy0*dy, dx, dy, nx, ny)
+    
+    def cellOf(self, xy):
+        ix = math.floor((xy[0] - self.x0) / self.dx)
+        iy = math.floor((xy[1] - self.y0) / self.dy)
+        if 0 <= ix < self.nx and 0 <= iy < self.ny:
+            return iy * self.nx + ix
+        return -1
+    
+    def edgeCells(self, x1, y1, x2, y2):
+        # All cells a segment passes through, padded by CELL_EPS so float
+        # rounding never leaves a touched cell out
+        if x1 > x2:
+            (x1, y1, x2, y2) = (x2, y2, x1, y1)
+        ixa = max(0, math.floor((x1 - CELL_EPS - self.x0) / self.dx))
+        ixb = min(self.nx - 1, math.floor((x2 + CELL_EPS - self.x0) / self.dx))
+        for ix in range(ixa, ixb + 1):
+            # clip the segment to this column
+            cxa = max(x1, self.x0 + ix * self.dx)
+            cxb = min(x2, self.x0 + (ix + 1) * self.dx)
+            if x2 > x1:
+                ya = y1 + (y2 - y1) * (cxa - x1) / (x2 - x1)
+                yb = y1 + (y2 - y1) * (cxb - x1) / (x2 - x1)
+            else:
+                (ya, yb) = (y1, y2)
+            iya = max(0, math.floor((min(ya, yb) - CELL_EPS - self.y0) / self.dy))
+            iyb = min(self.ny - 1, math.floor((max(ya, yb) + CELL_EPS - self.y0) / self.dy))
+            for iy in range(iya, iyb + 1):
+                yield iy * self.nx + ix
+    
+    def label(self, boundaries, classify):
+        self.cells = cells = array('i', [CELL_UNSET]) * (self.nx * self.ny)
+        for bnd in boundaries:
+            for (x1,y1,x2,y2,m,b) in bnd.edges():
+                for c in self.edgeCells(x1, y1, x2, y2):
+                    cells[c] = CELL_EDGE
+        
+        # flood fill the remaining cells region by region
+        nx = self.nx
+        for start in range(len(cells)):
+            if cells[start] != CELL_UNSET:
+                continue
+            (ix, iy) = (start % nx, start // nx)
+            # sample off center, boundary files often have vertices on
+            # round coordinates and a fix level with a vertex is degenerate
+            value = classify((self.x0 + (ix + CELL_SAMPLE[0]) * self.dx, self.y0 + (iy + CELL_SAMPLE[1]) * self.dy))
+            cells[start] = value
+            todo = [start]
+            while todo:
+                c = todo.pop()
+                ix = c % nx
+                for (n, ok) in ((c - 1, ix > 0), (c + 1, ix < nx - 1), (c - nx, c >= nx), (c + nx, c + nx < len(cells))):
+                    if ok and cells[n] == CELL_UNSET:
+                        cells[n] = value
+                        todo.append(n)
+    
+    def cellBounds(self, c):
+        (ix, iy) = (c % self.nx, c // self.nx)
+        x = self.x0 + ix * self.dx
+        y = self.y0 + iy * self.dy
+        return (x, y, x + self.dx, y + self.dy)
+
+class geoEdgeIndex():
+    # Lattice of boundary edges for casting rays ahead of the vehicle.
+    # Cell c lists edges first[c] .. first[c]+count[c]-1 of the flat bid
+    # (boundary id) and eid (edge number) arrays, coords holds x1, y1, x2,
+    # y2 of each entry so a cell's edges can be measured in one slice.
+    def __init__(self, boundaries, cell=0.02):
+        self.boundaries = boundaries
+        self.lattice = None
+        self.cells = {}
+        self.bid = array('i')
+        self.eid = array('i')
+        self.coords = array('d')
+        self.build_time = 0.0
+        if not boundaries:
+            return
+        
+        t = time.perf_counter()
+        self.lattice = geoCellMap.covering(boundaries, cell, cell)
+        buckets = {}
+        for bnd in boundaries:
+            for (e,(x1,y1,x2,y2,m,b)) in enumerate(bnd.edges()):
+                for c in self.lattice.edgeCells(x1, y1, x2, y2):
+                    buckets.setdefault(c, []).append((bnd.id, e))
+        for (c,edges) in buckets.items():
+            self.cells[c] = (len(self.bid), len(edges))
+            for (b,e) in edges:
+                self.bid.append(b)
+                self.eid.append(e)
+                bnd = boundaries[b]
+                self.coords.extend((bnd.xs[e], bnd.ys[e], bnd.xs[e+1], bnd.ys[e+1]))
+        self.build_time = time.perf_counter() - t
+    
+    def getState(self):
+        state = dict(self.__dict__)
+        state.pop("boundaries")
+        return state
+    
+    @staticmethod
+    def fromState(state, boundaries):
+        index = geoEdgeIndex.__new__(geoEdgeIndex)
+        index.__dict__.update(state)
+        index.boundaries = boundaries
+        return index
+    
+    def castRay(self, xy, course, dist):
+        # Nearest edge hit by a ray of length dist (degrees of latitude)
+        # leaving xy on course (degrees true).  Returns (distance, boundary,
+        # edge) or None when nothing is hit within dist.
+        if self.lattice is None:
+            return None
+        (x,y) = xy
+        kx = math.cos(math.radians(y))
+        rx = math.sin(math.radians(course)) / kx * dist
+        ry = math.cos(math.radians(course)) * dist
+        
+        hits = self.segmentHits(x, y, x + rx, y + ry)
+        if not hits:
+            return None
+        (t, bnd, e) = min(hits, key=lambda h: h[0])
+        return (t * dist, bnd, e)
+    
+    def segmentHits(self, x1, y1, x2, y2):
+        # Every edge crossed by the segment as (t along the segment,
+        # boundary, edge), unordered
+        hits = []
+        if self.lattice is None:
+            return hits
+        (rx, ry) = (x2 - x1, y2 - y1)
+        seen = set()
+        for c in self.lattice.edgeCells(x1, y1, x2, y2):
+            (first, count) = self.cells.get(c, (0, 0))
+            for k in range(first, first + count):
+                key = (self.bid[k], self.eid[k])
+                if key in seen:
+                    continue
+                seen.add(key)
+                bnd = self.boundaries[key[0]]
+                (ax, ay) = (bnd.xs[key[1]], bnd.ys[key[1]])
+                sx = bnd.xs[key[1]+1] - ax
+                sy = bnd.ys[key[1]+1] - ay
+                den = rx*sy - ry*sx
+                if den == 0:
+                    continue
+                t = ((ax - x1)*sy - (ay - y1)*sx) / den
+                u = ((ax - x1)*ry - (ay - y1)*rx) / den
+                if 0 <= t <= 1 and 0 <= u <= 1:
+                    hits.append((t, bnd, key[1]))
+        return hits
+    
+    def cellSpans(self, minx, miny, maxx, maxy):
+        # (first, count) of every non-empty cell overlapping the box
+        spans = []
+        if self.lattice is None:
+            return spans
+        lat = self.lattice
+        ixa = max(0, math.floor((minx - lat.x0) / lat.dx))
+        ixb = min(lat.nx - 1, math.floor((maxx - lat.x0) / lat.dx))
+        iya = max(0, math.floor((miny - lat.y0) / lat.dy))
+        iyb = min(lat.ny - 1, math.floor((maxy - lat.y0) / lat.dy))
+        for iy in range(iya, iyb + 1):
+            for ix in range(ixa, ixb + 1):
+                span = self.cells.get(iy * lat.nx + ix)
+                if span:
+                    spans.append(span)
+        return spans
+    
+    def edgesInBox(self, minx, miny, maxx, maxy):
+        # Every edge in the cells overlapping the box as (x1, y1, x2, y2)
+        seen = set()
+        for (first, count) in self.cellSpans(minx, miny, maxx, maxy):
+            for k in range(first, first + count):
+                key = (self.bid[k], self.eid[k])
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield tuple(self.coords[4*k:4*k+4])
+    
+    def nearestEdge(self, xy, kx, limit):
+        # Distance from xy to the closest edge, longitude is scaled by kx
+        # so the result is in degrees of latitude.  Only cells within limit
+        # are searched, anything further away comes back as limit.  None
+        # when there are no edges at all.
+        if not self.bid:
+            return None
+        (x,y) = xy
+        spans = self.cellSpans(x - limit/kx, y - limit, x + limit/kx, y + limit)
+        if not spans:
+            return limit
+        
+        if np is not None and sum(count for (_,count) in spans) >= VECTOR_MIN_EDGES:
+            # a cell's duplicates in its neighbours do not change the minimum
+            seg = np.frombuffer(self.coords, dtype=np.float64).reshape(-1, 4)
+            seg = np.concatenate([seg[first:first+count] for (first,count) in spans])
+            ex = (seg[:,2] - seg[:,0]) * kx
+            ey = seg[:,3] - seg[:,1]
+            px = (x - seg[:,0]) * kx
+            py = y - seg[:,1]
+            ll = ex*ex + ey*ey
+            t = np.divide(px*ex + py*ey, ll, out=np.zeros_like(ll), where=ll > 0)
+            np.clip(t, 0.0, 1.0, out=t)
+            best = float(np.min((px - t*ex)**2 + (py - t*ey)**2))
+            return min(limit, math.sqrt(best))
+        
+        best = math.inf
+        c = self.coords
+        for (first,count) in spans:
+            for k in range(4*first, 4*(first + count), 4):
+                ex = (c[k+2] - c[k]) * kx
+                ey = c[k+3] - c[k+1]
+                px = (x - c[k]) * kx
+                py = y - c[k+1]
+                ll = ex*ex + ey*ey
+                t = (px*ex + py*ey) / ll if ll > 0 else 0.0
+                if t < 0.0:
+                    t = 0.0
+                elif t > 1.0:
+                    t = 1.0
+                dx = px - t*ex
+                dy = py - t*ey
+                d = dx*dx + dy*dy
+                if d < best:
+                    best = d
+        return min(limit, math.sqrt(best))
+
+class geoRoute():
+    # Planned route with every county/city and grid crossing worked out up
+    # front.  Each route segment is cut at the county/city lines and into
+    # chunks of at most ROUTE_CHUNK_M.  Every chunk records its county/city
+    # and its clearance, the distance to the nearest boundary edge up to
+    # ROUTE_CORRIDOR_M.  A fix closer to a chunk than its clearance can not
+    # be across a line from it, anything else falls back to findCAIC.
+    def __init__(self, points):
+        self.xs = array('d', (p[0] for p in points))
+        self.ys = array('d', (p[1] for p in points))
+        self.minx = min(self.xs)
+        self.maxx = max(self.xs)
+        self.miny = min(self.ys)
+        self.maxy = max(self.ys)
+        
+        # cumulative along track distance in meters at every point
+        self.along = array('d', [0.0])
+        for i in range(len(self.xs) - 1):
+            self.along.append(self.along[-1] + self.segmentLength(i))
+        
+        # segment lattice for finding the route near a fix
+        self.lattice = geoCellMap.covering([self], 0.01, 0.01)
+        self.seg_cells = {}
+        for i in range(len(self.xs) - 1):
+            for c in self.lattice.edgeCells(self.xs[i], self.ys[i], self.xs[i+1], self.ys[i+1]):
+                self.seg_cells.setdefault(c, []).append(i)
+        
+        self.chunks = []
+        self.crossings = {geoMsg.CNTY: [], geoMsg.GRID: []}
+        self.bset = None # boundary set the route was planned against
+    
+    @staticmethod
+    def readPoints(filename, det):
+        # GPX track/route points, KML LineString coordinates or GGA fixes
+        # from an NMEA log, consecutive duplicates removed
+        points = []
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in (".gpx", ".kml"):
+            stack = []
+            for (event, elem) in xml.etree.ElementTree.iterparse(filename, events=("start", "end")):
+                tag = elem.tag.rpartition('}')[2]
+                if event == "start":
+                    stack.append(tag)
+                    continue
+                stack.pop()
+                if tag in ("trkpt", "rtept"):
+                    points.append((float(elem.get("lon")), float(elem.get("lat"))))
+                elif tag == "coordinates" and stack and stack[-1] == "LineString" and elem.text:
+                    for xy in elem.text.split():
+                        (x, y) = xy.split(',')[:2]
+                        points.append((float(x), float(y)))
+                if tag in ("trkpt", "rtept", "Placemark"):
+                    elem.clear()
+        else:
+            with open(filename) as fp:
+                for buf in fp:
+                    rec = geoNmea.parseLogged(buf, det.replay_source)
+                    if type(rec) is geoNmeaGGA:
+                        try:
+                            points.append(det.getNmeaGgaCoords(rec, notify=False))
+                        except ValueError:
+                            pass
+        return [p for (i,p) in enumerate(points) if i == 0 or p != points[i-1]]
+    
+    def segmentLength(self, i):
+        kx = math.cos(math.radians((self.ys[i] + self.ys[i+1]) / 2))
+        return math.hypot((self.xs[i+1] - self.xs[i]) * kx, self.ys[i+1] - self.ys[i]) * DEG_M
+    
+    def plan(self, det):
+        # Boundary ids in the plan belong to det's set, recorded in bset
+        self.bset = det.bset
+        self.chunks = []
+        self.crossings = {geoMsg.CNTY: [], geoMsg.GRID: []}
+        last = {geoMsg.CNTY: None, geoMsg.GRID: None}
+        (gw, gh) = det.gridSize(det.grid_precision)
+        
+        for i in range(len(self.xs) - 1):
+            (x1, y1, x2, y2) = (self.xs[i], self.ys[i], self.xs[i+1], self.ys[i+1])
+            kx = math.cos(math.radians((y1 + y2) / 2))
+            seglen = self.along[i+1] - self.along[i]
+            
+            # grid lines of the configured locator length
+            gcuts = {0.0, 1.0}
+            for (a, b, step, origin) in ((x1, x2, gw, -180), (y1, y2, gh, -90)):
+                if a != b:
+                    for k in range(math.floor((min(a, b) - origin) / step) + 1, math.floor((max(a, b) - origin) / step) + 1):
+                        gcuts.add((origin + k * step - a) / (b - a))
+            gcuts = sorted(c for c in gcuts if 0.0 <= c <= 1.0)
+            for (t0, t1) in zip(gcuts, gcuts[1:]):
+                if t1 <= t0:
+                    continue
+                tm = t0 + (t1 - t0) * CELL_SAMPLE[0]
+                grid = det.gridLocator((x1 + (x2 - x1) * tm, y1 + (y2 - y1) * tm), det.grid_precision)[0]
+                if grid != last[geoMsg.GRID]:
+                    if last[geoMsg.GRID] is not None:
+                        self.crossings[geoMsg.GRID].append((self.along[i] + t0 * seglen, grid))
+                    last[geoMsg.GRID] = grid
+            
+            # cut at county/city lines and every ROUTE_CHUNK_M
+            cuts = {0.0, 1.0}
+            cuts.update(h[0] for h in det.edge_index.segmentHits(x1, y1, x2, y2))
+            n = max(1, math.ceil(seglen / ROUTE_CHUNK_M))
+            cuts.update(k / n for k in range(1, n))
+            cuts = sorted(c for c in cuts if 0.0 <= c <= 1.0)
+            
+            chunks = []
+            for (t0, t1) in zip(cuts, cuts[1:]):
+                if t1 <= t0:
+                    continue
+                # off center like geoCellMap, fixes level with a vertex
+                # are degenerate
+                tm = t0 + (t1 - t0) * CELL_SAMPLE[0]
+                mid = (x1 + (x2 - x1) * tm, y1 + (y2 - y1) * tm)
+                qth = det.matchCAIC(mid)
+                qid = qth.id if qth else CELL_UNKNOWN
+                
+                # record a crossing whenever the chunk differs from the last
+                if qid != last[geoMsg.CNTY]:
+                    if last[geoMsg.CNTY] is not None:
+                        self.crossings[geoMsg.CNTY].append((self.along[i] + t0 * seglen, qth.abbr if qth else "UNK"))
+                    last[geoMsg.CNTY] = qid
+                
+                ax = x1 + (x2 - x1) * t0
+                ay = y1 + (y2 - y1) * t0
+                bx = x1 + (x2 - x1) * t1
+                by = y1 + (y2 - y1) * t1
+                chunks.append((t0, t1, qid, self.clearance(det, ax, ay, bx, by, kx)))
+            self.chunks.append(chunks)
+    
+    def clearance(self, det, ax, ay, bx, by, kx):
+        # Distance in degrees of latitude from the chunk a-b to the nearest
+        # boundary edge, capped at ROUTE_CORRIDOR_M
+        best = ROUTE_CORRIDOR_M / DEG_M
+        pad = best / kx
+        for (cx, cy, dx, dy) in det.edge_index.edgesInBox(min(ax, bx) - pad, min(ay, by) - best, max(ax, bx) + pad, max(ay, by) + best):
+            best = min(best, geoRoute.segmentDistance(ax, ay, bx, by, cx, cy, dx, dy, kx))
+        return best
+    
+    @staticmethod
+    def segmentDistance(ax, ay, bx, by, cx, cy, dx, dy, kx):
+        # Distance between segments a-b and c-d with x scaled by kx
+        ux = (bx - ax) * kx
+        uy = by - ay
+        vx = (dx - cx) * kx
+        vy = dy - cy
+        wx = (cx - ax) * kx
+        wy = cy - ay
+        den = ux*vy - uy*vx
+        if den != 0:
+            t = (wx*vy - wy*vx) / den
+            u = (wx*uy - wy*ux) / den
+            if 0 <= t <= 1 and 0 <= u <= 1:
+                return 0.0
+        return min(geoRoute.pointDistance(cx, cy, ax, ay, bx, by, kx),
+                   geoRoute.pointDistance(dx, dy, ax, ay, bx, by, kx),
+                   geoRoute.pointDistance(ax, ay, cx, cy, dx, dy, kx),
+                   geoRoute.pointDistance(bx, by, cx, cy, dx, dy, kx))
+    
+    @staticmethod
+    def pointDistance(px, py, ax, ay, bx, by, kx):
+        # Distance from p to segment a-b and the position t along a-b
+        ex = (bx - ax) * kx
+        ey = by - ay
+        qx = (px - ax) * kx
+        qy = py - ay
+        ll = ex*ex + ey*ey
+        t = min(1.0, max(0.0, (qx*ex + qy*ey) / ll)) if ll > 0 else 0.0
+        return math.hypot(qx - t*ex, qy - t*ey)
+    
+    def locate(self, xy, last_seg=-1):
+        # Closest route segment within ROUTE_CORRIDOR_M of xy, preferring
+        # segments just ahead of last_seg, the one the caller matched last.
+        # Returns (segment, t, distance in degrees of latitude) or None when
+        # off route.
+        c = self.lattice.cellOf(xy)
+        if c < 0:
+            return None
+        kx = math.cos(math.radians(xy[1]))
+        best = None
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                for i in self.seg_cells.get(c + dy * self.lattice.nx + dx, ()):
+                    (x1, y1, x2, y2) = (self.xs[i], self.ys[i], self.xs[i+1], self.ys[i+1])
+                    d = geoRoute.pointDistance(xy[0], xy[1], x1, y1, x2, y2, kx)
+                    if d > ROUTE_CORRIDOR_M / DEG_M:
+                        continue
+                    near = last_seg - 2 <= i <= last_seg + 50
+                    if best is None or (not near, d) < (not best[3], best[2]):
+                        ex = (x2 - x1) * kx
+                        ey = y2 - y1
+                        ll = ex*ex + ey*ey
+                        t = min(1.0, max(0.0, ((xy[0] - x1)*kx*ex + (xy[1] - y1)*ey) / ll)) if ll > 0 else 0.0
+                        best = (i, t, d, near)
+        if best is None:
+            return None
+        return best[:3]
+    
+    def lookup(self, xy, last_seg=-1):
+        # Returns (boundary id or None, along track meters, segment) when on
+        # the route, the id is None where the fix is too close to a line.
+        # The route is shared, each detector passes its own last segment.
+        loc = self.locate(xy, last_seg)
+        if loc is None:
+            return None
+        (i, t, d) = loc
+        along = self.along[i] + t * (self.along[i+1] - self.along[i])
+        for (t0, t1, qid, clear) in self.chunks[i]:
+            if t0 <= t <= t1:
+                return (qid if d < clear else None, along, i)
+        return (None, along, i)
+    
+    def nextCrossing(self, along, ctype):
+        # (distance m, name) of the next crossing of ctype past along
+        lst = self.crossings[ctype]
+        k = bisect.bisect_right(lst, (along, chr(0x10ffff)))
+        if k >= len(lst):
+            return None
+        return (lst[k][0] - along, lst[k][1])
+
+class geoBoundarySet():
+    # Everything built from one boundary file.  loadBoundaries fills a new
+    # set and nothing changes it afterwards, so any number of detectors and
+    # threads can share one set.  A reload builds a replacement set.
+    __slots__ = ("boundaries", "index", "nesting", "subsquares", "raster", "edge_index")
+    
+    def __init__(self):
+        self.boundaries = []
+        self.index = geoGridIndex([])
+        self.nesting = {} # boundary id -> ids whose first vertex it contains
+        self.subsquares = {} # grid subsquare -> boundary id without edges
+        self.raster = None # optional fine geoCellMap of boundary ids
+        self.edge_index = geoEdgeIndex([])
+
+def _shared(name):
+    # Detector attribute stored in its geoBoundarySet
+    return property(lambda self: getattr(self.bset, name), lambda self, value: setattr(self.bset, name, value))
+
 class arGeoDetector(Thread):
+    boundaries = _shared("boundaries")
+    index = _shared("index")
+    nesting = _shared("nesting")
+    subsquares = _shared("subsquares")
+    raster = _shared("raster")
+    edge_index = _shared("edge_index")
+    
     def __init__(self, serial, cb, log=0, nmea=0, mode=0):
         Thread.__init__(self)
         
-        self.boundaries = []
+        self.bset = geoBoundarySet()
+        self.bset_next = None # (set, route) to switch to before the next fix
+        self.overlaps = {} # resolved overlap combinations
+        self.raster_res = 0 # raster cell size in degrees, 0 disables
+        self.simplify_m = 0 # simplification tolerance in meters, 0 disables
+        self.grid_precision = 6 # locator length, 6, 8 or 10
+        self.grid_cache = None # (precision, inner bounds, locator, bounds)
+        self.next_cnty = None # (boundary id, edge, name) of last predicted crossing
+        self.next_moving = False
+        self.last_knots = 0.0
+        self.route = None # optional planned geoRoute
+        self.route_on = False
+        self.route_seg = -1 # route segment of the last fix on the route
+        self.index_engine = "grid" # grid or rtree
+        self.cache_dir = None # precompiled boundary cache location
         self.mode = 0 # 0 = gui, 1 = cli
         self.verbose = False
+        self.source = None # input name prefixed to log lines
+        self.replay_source = None # tagged source read back from NMEA logs
         
         self.log_main = log
         self.log_nmea = nmea
         
         self.last_grid = ""
         self.last_qth = ""
+        self.qth_cache = None
+        self.index_queries = 0 # lookups through the shared index and their time
+        self.index_time = 0.0
         self.last_datetime = datetime.datetime.now(datetime.timezone.utc)
          
         self.gps_lock = False
@@ -147,62 +1192,354 @@ class arGeoDetector(Thread):
         self.state = 0
         self.in_state = -1
         self._do_exit = 0
-        self.lock = threading.Lock()
+        # guards state changes, waiters are notified on every change
+        self.lock = threading.Condition()
 
         self.com = serial
-        self.msgCB = cb
+        self.rx_buf = bytearray() # received bytes not yet framed into lines
+        self.rx_lines = deque() # decoded lines waiting to be processed
+        self.retry = 0 # delay before the next port open, 0 opens at once
+        self.msg_cb = cb
+        self.last_msgs = {} # last state message sent per kind
         
     def loadBoundaries(self, filename):
-        self.boundaries = []
+        # Build into a new set on a clone and swap it in with a replanned
+        # route once complete, fixes arriving meanwhile use the old set.
+        # A failed load keeps the current set, other detectors sharing the
+        # old set keep it until they are handed the new one.
+        builder = self.clone(self.msgCB, self.source)
+        builder.bset = geoBoundarySet()
+        builder.route = None
+        if not builder.buildBoundaries(filename):
+            return False
+        
+        route = None
+        if self.route:
+            # crossings depend on the boundaries, plan a new copy of the
+            # route, detectors sharing the old set keep the old one
+            route = geoRoute(list(zip(self.route.xs, self.route.ys)))
+            route.plan(builder)
+        self.switchBoundaries((builder.bset, route))
+        return True
+    
+    def buildBoundaries(self, filename):
+        # Fill this detector's (unshared) set from filename
+        # Use the precompiled copy of this file if one exists
+        key = self.cacheKey(filename)
+        if key and self.readCache(key):
+            self.log("Boundary file loaded from cache")
+        else:
+            if not self.parseBoundaryFile(filename):
+                return False
+            self.simplifyBoundaries()
+            self.buildIndex()
+            self.buildNesting()
+            self.buildSubsquares()
+            self.edge_index = geoEdgeIndex(self.boundaries)
+            self.log("Edge index built in %.1f ms" % (self.edge_index.build_time * 1e3))
+            if key:
+                self.writeCache(key)
+            self.log("Boundary file loaded")
+        if self.raster_res > 0 and self.boundaries:
+            self.loadRaster(key)
+        self.log(self.index.report(self.index_queries, self.index_time))
+        self.log(self.memoryReport())
+        return True
+    
+    def loadRaster(self, key):
+        # The raster is shared across runs through a file next to the
+        # boundary cache, built on first use
+        rasterfile = None
+        if key:
+            rasterfile = "%s-%g.ras" % (os.path.splitext(key)[0], self.raster_res)
+            self.raster = self.readRaster(rasterfile)
+            if self.raster:
+                self.log("Boundary raster loaded from cache")
+                return
         
-        # Load Kml file into string so I can remove the 
-        # xmlns="http://earth.google.com/kml/2.1" string
-        # from the <kml> tag.  I don't know why but this 
-        # breaks the subsequent element tree?????
+        t = time.perf_counter()
+        self.raster = geoCellMap.covering(self.boundaries, self.raster_res, self.raster_res)
+        self.raster.label(self.boundaries, self.matchId)
+        self.log("Boundary raster %dx%d built in %.1f s" % (self.raster.nx, self.raster.ny, time.perf_counter() - t))
+        if rasterfile:
+            self.writeRaster(rasterfile)
+    
+    def writeRaster(self, rasterfile):
+        # Layout: magic, version, lattice origin, cell size and dimensions
+        # padded to RASTER_HEADER bytes followed by the int32 cells
+        r = self.raster
+        head = RASTER_MAGIC + struct.pack("<IddddII", CACHE_VERSION, r.x0, r.y0, r.dx, r.dy, r.nx, r.ny)
+        head += b"\0" * (RASTER_HEADER - len(head))
+        try:
+            tmpfile = rasterfile + ".tmp"
+            with open(tmpfile, "wb") as fp:
+                fp.write(head)
+                fp.write(r.cells)
+            os.replace(tmpfile, rasterfile)
+        except OSError as e:
+            self.log("Unable to write boundary raster [%s]" % str(e))
+    
+    def readRaster(self, rasterfile):
+        try:
+            with open(rasterfile, "rb") as fp:
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
         
-        xmlstr = ""
         try:
-            kmlin = open(filename)
-            for line in kmlin.readlines():
-                xmlstr += line.replace(" xmlns=\"http://earth.google.com/kml/2.1\"","")
-        except:
+            if mm[:4] != RASTER_MAGIC:
+                raise ValueError("bad magic")
+            (version, x0, y0, dx, dy, nx, ny) = struct.unpack_from("<IddddII", mm, 4)
+            if version != CACHE_VERSION or len(mm) != RASTER_HEADER + 4 * nx * ny:
+                raise ValueError("stale raster")
+        except (ValueError, struct.error):
+            mm.close()
+            return None
+        
+        r = geoCellMap.__new__(geoCellMap)
+        (r.x0, r.y0, r.dx, r.dy, r.nx, r.ny) = (x0, y0, dx, dy, nx, ny)
+        r.cells = memoryview(mm)[RASTER_HEADER:].cast('i')
+        return r
+    
+    def parseBoundaryFile(self, filename):
+        # Stream the KML with iterparse, each Placemark is converted as soon
+        # as it is complete and then dropped from the tree so memory use
+        # does not grow with the file.  Tags are matched on their local
+        # name so the xmlns="http://earth.google.com/kml/2.1" namespace
+        # does not need to be stripped.
+        stack = []
+        try:
+            for (event, elem) in xml.etree.ElementTree.iterparse(filename, events=("start", "end")):
+                if event == "start":
+                    stack.append(elem)
+                    continue
+                stack.pop()
+                if elem.tag.rpartition('}')[2] != "Placemark":
+                    continue
+                
+                self.parsePlacemark(elem)
+                elem.clear()
+                if stack:
+                    stack[-1].remove(elem)
+        except (OSError, xml.etree.ElementTree.ParseError):
             self.msgCB((geoMsg.STAT, "Error reading boundary file [%s]!" % filename))
-            #print ("Error reading boundary file [%s]!" % filename)
-            #quit(1)
+            return False
+        return True
+    
+    def parsePlacemark(self, xplacemark):
+        for xname in xplacemark.iter():
+            if xname.tag.rpartition('}')[2] != "name" or not xname.text:
+                continue
+            # extract name info
+            # Form: 'Fauquier=FAU 1'
+            # only process '1' entries
+            m = re.search('(\\w+)=(\\w+) 1', xname.text)
+            if (m): # If match succeeds
+                name = m.group(1)
+                abbr = m.group(2)
+                self.log ("Loading %s(%s)" % (abbr, name))
+                # Create new boundary object
+                bnd = geoBoundary(name, abbr)
+                
+                # Add coordinates to boundary object
+                # Form: '-75.87614423,37.55153989' whitespace separated
+                for xcoords in xplacemark.iter():
+                    if xcoords.tag.rpartition('}')[2] != "coordinates" or not xcoords.text:
+                        continue
+                    for xy in xcoords.text.split():
+                        (x, y) = xy.split(',')[:2]
+                        bnd.xs.append(float(x))
+                        bnd.ys.append(float(y))
+                    
+                    # Wrap coordinate list by copying entry 0 to the end
+                    bnd.wrapCoord()
+                
+                # a name without coordinates can never match a fix
+                if not len(bnd.xs):
+                    continue
+                bnd.id = len(self.boundaries)
+                self.boundaries.append(bnd)
+    
+    def simplifyBoundaries(self):
+        # Optional simplified outlines, contains() stays exact by falling
+        # back to the full outline within the error band
+        for bnd in self.boundaries:
+            bnd.simple = None
+            if self.simplify_m > 0 and len(bnd.xs) > 2:
+                bnd.simplify(self.simplify_m / DEG_M)
+        if self.simplify_m > 0:
+            verts = sum(len(b.xs) for b in self.boundaries)
+            simple = sum(len((b.simple or b).xs) for b in self.boundaries)
+            self.log("Simplified %d to %d vertices at %g m" % (verts, simple, self.simplify_m))
+    
+    def buildIndex(self):
+        # Build spatial index so findCAIC only tests nearby boundaries
+        if self.index_engine == "rtree":
+            self.index = geoRTreeIndex(self.boundaries)
+        else:
+            self.index = geoGridIndex(self.boundaries)
+    
+    def buildNesting(self):
+        # Record for every boundary which other boundaries have their first
+        # vertex inside it.  This is the test findCAIC uses to pick the
+        # city out of a city/county overlap, done once here instead of on
+        # every ambiguous fix.
+        self.nesting = {b.id: set() for b in self.boundaries}
+        for bnd in self.boundaries:
+            c = bnd.firstCoord()
+            for other in self.index.query(c):
+                if other is not bnd and other.contains(c):
+                    self.nesting[other.id].add(bnd.id)
+        self.overlaps = {}
+    
+    def buildSubsquares(self):
+        # Map every 6 character subsquare over the loaded area that no
+        # boundary line crosses straight to its county/city.  Subsquares
+        # with a line through them are left out and take the full lookup.
+        self.subsquares = {}
+        if not self.boundaries:
+            return
+        t = time.perf_counter()
+        cm = geoCellMap.covering(self.boundaries, 2/24, 1/24, -180, -90)
+        cm.label(self.boundaries, self.matchId)
+        for (c,value) in enumerate(cm.cells):
+            if value != CELL_EDGE:
+                (x0, y0, x1, y1) = cm.cellBounds(c)
+                self.subsquares[self.gridLocator(((x0 + x1) / 2, (y0 + y1) / 2))[0]] = value
+        self.log("Subsquare table: %d of %d subsquares resolved in %.1f ms" %
+                 (len(self.subsquares), len(cm.cells), (time.perf_counter() - t) * 1e3))
+    
+    def matchId(self, xy):
+        qth = self.matchCAIC(xy)
+        return qth.id if qth else CELL_UNKNOWN
+    
+    def cacheKey(self, filename):
+        # Cache files are named after the source path hash followed by the
+        # content hash and mtime, so the caches of one file share a prefix
+        if not self.cache_dir:
+            return None
+        try:
+            p = hashlib.sha1(os.path.abspath(filename).encode()).hexdigest()[:CACHE_PREFIX_LEN]
+            h = hashlib.sha1()
+            with open(filename, "rb") as fp:
+                for chunk in iter(lambda: fp.read(1 << 20), b""):
+                    h.update(chunk)
+            h.update(str(os.stat(filename).st_mtime_ns).encode())
+        except OSError:
+            return None
+        return os.path.join(self.cache_dir, "%s-%s.bnd" % (p, h.hexdigest()))
+    
+    def writeCache(self, cachefile):
+        # Layout: magic, version, metadata length, pickled metadata, then
+        # 8 byte aligned doubles xs, ys, ms, bs for every boundary in turn,
+        # followed by the same for its simplified outline if it has one
+        meta = {
+            "bnds": [(b.name, b.abbr, len(b.xs), b.minx, b.miny, b.maxx, b.maxy,
+                      len(b.simple.xs) if b.simple else 0, b.band, b.kx) for b in self.boundaries],
+            "simplify": self.simplify_m,
+            "index": self.index.getState(),
+            "nesting": self.nesting,
+            "subsquares": self.subsquares,
+            "edges": self.edge_index.getState(),
+        }
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            blob = pickle.dumps(meta, pickle.HIGHEST_PROTOCOL)
+            head = CACHE_MAGIC + struct.pack("<IQ", CACHE_VERSION, len(blob)) + blob
+            head += b"\0" * (-len(head) % 8)
+            tmpfile = cachefile + ".tmp"
+            with open(tmpfile, "wb") as fp:
+                fp.write(head)
+                for bnd in self.boundaries:
+                    for b in (bnd, bnd.simple):
+                        if b is not None:
+                            for a in (b.xs, b.ys, b.ms, b.bs):
+                                fp.write(a)
+            os.replace(tmpfile, cachefile)
+        except (OSError, pickle.PicklingError) as e:
+            self.log("Unable to write boundary cache [%s]" % str(e))
+            return
+        self.pruneCache(cachefile)
+    
+    def pruneCache(self, cachefile):
+        # Delete the caches and rasters of earlier versions of the same
+        # source file, and those named before the path prefix was added
+        stem = os.path.splitext(os.path.basename(cachefile))[0]
+        prefix = stem.partition('-')[0] + '-'
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
             return
+        for name in names:
+            (base, ext) = os.path.splitext(name)
+            if ext not in (".bnd", ".ras") or name.startswith(stem):
+                continue
+            if name.startswith(prefix) or re.fullmatch("[0-9a-f]{40}(-[^-]+)?", base):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                    self.log("Removed stale boundary cache %s" % name)
+                except OSError:
+                    pass
+    
+    def readCache(self, cachefile):
+        # Memory map a cache file, the boundary arrays become views of the
+        # mapping so nothing is parsed or copied
+        try:
+            with open(cachefile, "rb") as fp:
+                mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
         
-        e = xml.etree.ElementTree.fromstring(xmlstr)
-        #e = xml.etree.ElementTree.parse(filename).getroot()
-
-        for xplacemark in e[0].iter('Placemark'):
-            for xname in xplacemark.iter('name'):
-                # extract name info
-                # Form: 'Fauquier=FAU 1'
-                # only process '1' entries
-                m = re.search('(\\w+)=(\\w+) 1', xname.text)
-                if (m): # If match succeeds
-                    name = m.group(1)
-                    abbr = m.group(2)
-                    self.log ("Loading %s(%s)" % (abbr, name))
-                    # Create new boundary object
-                    bnd = geoBoundary(name, abbr)
-                    
-                    # Add coordinates to boundary object
-                    # Form: '-75.87614423,37.55153989'
-                    for xcoords in xplacemark.iter('coordinates'):
-                        lines = xcoords.text.strip().split('\n')
-                        for line in lines:
-                            sline = line.strip() # remove whitespace
-                            xy = sline.split(',')
-                            #print ("X> %s, Y> %s" % (xy[0], xy[1]))
-                            # Add coordinate to object
-                            bnd.addCoord((float(xy[0]), float(xy[1])))
-                            
-                        # Wrap coordinate list by copying entry 0 to the end
-                        bnd.wrapCoord()
-                    
-                    self.boundaries.append(bnd)
-        self.log("Boundary file loaded")
+        try:
+            if mm[:4] != CACHE_MAGIC:
+                raise ValueError("bad magic")
+            (version, size) = struct.unpack_from("<IQ", mm, 4)
+            if version != CACHE_VERSION:
+                raise ValueError("unsupported version")
+            start = 16 + size
+            meta = pickle.loads(mm[16:start])
+        except Exception:
+            mm.close()
+            return False
+        
+        data = memoryview(mm)[start + (-start % 8):].cast('d')
+        pos = 0
+        bnds = []
+        for (name, abbr, n, minx, miny, maxx, maxy, ns, band, kx) in meta["bnds"]:
+            bnd = geoBoundary(name, abbr)
+            bnd.id = len(bnds)
+            (bnd.minx, bnd.miny, bnd.maxx, bnd.maxy) = (minx, miny, maxx, maxy)
+            for (b,cnt) in ((bnd, n), (geoBoundary(name, abbr), ns)):
+                if not cnt:
+                    continue
+                for attr in ("xs", "ys", "ms", "bs"):
+                    setattr(b, attr, data[pos:pos+cnt-(attr in ("ms", "bs"))])
+                    pos += cnt - (attr in ("ms", "bs"))
+                if b is not bnd:
+                    b.minx = min(b.xs)
+                    b.maxx = max(b.xs)
+                    b.miny = min(b.ys)
+                    b.maxy = max(b.ys)
+                    (bnd.simple, bnd.band, bnd.kx) = (b, band, kx)
+            bnd.buildSpans()
+            bnds.append(bnd)
+        
+        self.boundaries = bnds
+        if meta["simplify"] != self.simplify_m:
+            self.simplifyBoundaries()
+        self.nesting = meta["nesting"]
+        self.subsquares = meta["subsquares"]
+        self.edge_index = geoEdgeIndex.fromState(meta["edges"], self.boundaries)
+        if meta["index"]["engine"] == self.index_engine:
+            self.index = geoIndex.fromState(meta["index"], self.boundaries)
+        else:
+            self.buildIndex()
+        return True
+    
+    def memoryReport(self):
+        verts = sum(len(b.xs) for b in self.boundaries)
+        used = sum(b.memoryUsage() for b in self.boundaries)
+        return "Boundary memory: %d boundaries, %d vertices, %.1f KiB" % (len(self.boundaries), verts, used / 1024)
     
 #    def enableLog(self, filename):
 #        try:
@@ -221,7 +1558,20 @@ class arGeoDetector(Thread):
 #        self.log_nmea.close()
 #        self.log_caic.close()
     
+    def msgCB(self, msg):
+        # Deliver msg, state messages only when they differ from the last
+        # one of their kind
+        key = geoEventBus.stateKey(msg)
+        if key is not None:
+            (t,s) = msg
+            if self.last_msgs.get(key) == s:
+                return
+            self.last_msgs[key] = s
+        self.msg_cb(msg)
+    
     def log(self, logstr, status=1):
+        if self.source:
+            logstr = "[%s] %s" % (self.source, logstr)
         if self.log_main:
             self.log_main.info(logstr)
         
@@ -229,7 +1579,10 @@ class arGeoDetector(Thread):
             self.msgCB((geoMsg.STAT,logstr))
 
     def logNMEA(self, logstr):
+        # receivers share the NMEA log, each line is tagged with its source
         if self.log_nmea:
+            if self.source:
+                logstr = "[%s] %s" % (self.source, logstr)
             self.log_nmea.info(logstr)
            
     def wdTick(self):
@@ -241,28 +1594,70 @@ class arGeoDetector(Thread):
             return 1
         return 0
             
+    def readLines(self):
+        # Pull whatever the port holds in one read and frame the complete
+        # lines out of rx_buf without copying.  A partial line stays in
+        # rx_buf for the next read.  The read blocks for at most the port
+        # timeout and never holds the lock.
+        if self.rx_lines:
+            return self.rx_lines
+        data = self.com.read(max(1, self.com.in_waiting))
+        if not data:
+            return self.rx_lines
+        self.rx_buf += data
+        bad = geoNmea.frame(self.rx_buf, self.rx_lines)
+        if bad:
+            raise UnicodeDecodeError('ascii', b'', 0, 1, "%d undecodable lines" % bad)
+        return self.rx_lines
+    
 #    def clirun(self):    
 
+    def setState(self, state):
+        # Change state and wake the serial thread and anyone waiting on it
+        with self.lock:
+            self.state = state
+            self.lock.notify_all()
+    
+    def enterState(self, state):
+        with self.lock:
+            self.in_state = state
+            self.lock.notify_all()
+    
+    def waitFor(self, predicate, timeout=None):
+        # Block until predicate() holds, a state change or exit re-checks it
+        with self.lock:
+            return self.lock.wait_for(lambda: predicate() or self._do_exit, timeout)
+    
+    def cancelRead(self):
+        # Wake a read blocked in the serial thread
+        if self.com.is_open and hasattr(self.com, "cancel_read"):
+            self.com.cancel_read()
+    
+    def isNetwork(self):
+        return isinstance(self.com, geoNetPort)
+    
     def openPort(self):
         #print ("open port")
         with self.lock:
             if not self.com.is_open:
-                self.state = 1
+                self.setState(1)
          
     def closePort(self):
         #print ("close port")
-        with self.lock:
-            self.state = 0
-        
-        while not self.in_state == 0:
-            time.sleep(0.1)
+        self.setState(0)
+        self.cancelRead()
+        if self.is_alive():
+            self.waitFor(lambda: self.in_state == 0)
             
         with self.lock:
             if self.com.is_open:
                 self.com.close()
     
     def stop(self):
-        self._do_exit = 1
+        with self.lock:
+            self._do_exit = 1
+            self.lock.notify_all()
+        self.cancelRead()
         
     def run(self):
         ## Serial Thread
@@ -281,74 +1676,99 @@ class arGeoDetector(Thread):
             # State 0
             if self.state == 0:
                 self.wdTick()
-                self.in_state = 0
+                self.enterState(0)
+                self.retry = 0
                 uniErrLimit = 3 # reset unicode error limit
                 self.log("Idle")
                 # auto exit if in cli mode
                 if self.mode == 1:
                     self._do_exit = 1
-                while self.state == 0 and not self._do_exit:
-                    time.sleep(1)
+                self.waitFor(lambda: self.state != 0)
                 
             # State 1
             if self.state == 1:
-                self.in_state = 1
+                self.enterState(1)
                 self.log("Opening serial port [%s @ %s]" % (self.com.port, self.com.baudrate))
                 fails_to_go = 5
+                # the delay doubles up to 2s, a replugged USB GPS reappears
+                # quickly, network sources keep retrying with a longer
+                # backoff.  It only starts over once data has arrived.
+                persistent = self.isNetwork()
+                retry_max = NET_RETRY_MAX if persistent else 2
                 while self.state == 1 and not self._do_exit:
+                    if self.retry:
+                        if self.waitFor(lambda: self.state != 1, self.retry):
+                            break
+                        self.retry = min(retry_max, self.retry * 2)
+                    else:
+                        self.retry = RETRY_MIN
                     try:
                         self.com.open()
-                        with self.lock:
-                            self.state = 2
+                        self.rx_buf.clear()
+                        self.rx_lines.clear()
+                        self.setState(2)
                         self.wdTick()
                     except serial.serialutil.SerialException as e:
                         self.log("Error opening serial port [%s]" % self.com.port)
-                        if self.wdCheck(1):
-                            with self.lock:
-                                self.state = 0
-                        fails_to_go -= 1
-                        if not fails_to_go:
-                            self.state = 0
-                        time.sleep(2)
+                        if not persistent:
+                            if self.wdCheck(1):
+                                self.setState(0)
+                            fails_to_go -= 1
+                            if not fails_to_go:
+                                self.setState(0)
             
             # State 2
             if self.state == 2:
-                self.in_state = 2
+                self.enterState(2)
                 self.log("Waiting for initial GPS data")
                 while self.state == 2 and not self._do_exit:
-                    if self.com.in_waiting > 0:
+                    # blocks until data arrives or the port timeout, what
+                    # is read stays queued for state 3
+                    try:
+                        lines = self.readLines()
+                    except UnicodeDecodeError:
+                        lines = True
+                    except serial.serialutil.SerialException as e:
+                        self.log("com error [%s]" % (str(e)))
                         with self.lock:
-                            self.state = 3
+                            self.com.close()
+                            self.setState(1)
+                        continue
+                    if lines or self.rx_buf:
+                        self.retry = RETRY_MIN
+                        self.setState(3)
                         self.wdTick()
                     elif self.wdCheck(5):
-                        self.log("Timeout waiting for initial GPS data, closing port")
+                        # network inputs wait for their source indefinitely
+                        if self.isNetwork():
+                            self.log("Timeout waiting for initial GPS data, reopening port")
+                        else:
+                            self.log("Timeout waiting for initial GPS data, closing port")
                         with self.lock:
                             self.com.close()
-                            self.state = 0
-                    else:
-                        time.sleep(1)
+                            self.setState(1 if self.isNetwork() else 0)
                 
             # State 3
             if self.state == 3:
-                self.in_state = 3
+                self.enterState(3)
                 self.log("Waiting for GPS Date/Time sync")
                 while self.state == 3 and not self._do_exit:
                     try:
-                        with self.lock:
-                            buf = self.com.readline().decode().rstrip()
-                        if buf:
+                        lines = self.readLines()
+                        while lines and self.state == 3:
+                            buf = lines.popleft()
                             self.logNMEA(buf)
                     
-                            # process GPRMC lines for date/time        
-                            m = re.search('^\\$GPRMC', buf)
-                            if (m):
+                            # process RMC lines for date/time        
+                            rec = geoNmea.parse(buf)
+                            if type(rec) is geoNmeaRMC:
                                 try:
-                                    self.updateNmeaRmcDateTime(buf)
+                                    self.updateNmeaRmcDateTime(rec)
                                 except ValueError:
                                     continue
                                 with self.lock:
                                     self.log("Date/Time synced!")
-                                    self.state = 4
+                                    self.setState(4)
                                 self.wdTick()
                                 
                     except UnicodeDecodeError:
@@ -359,76 +1779,38 @@ class arGeoDetector(Thread):
                         if uniErrLimit <= 0:
                             with self.lock:
                                 self.com.close()
-                                self.state = 0
+                                self.setState(0)
                     except serial.serialutil.SerialException as e:
                         self.log("com error [%s]" % (str(e)))
                         self.msgCB((geoMsg.GRID,"-"))
                         self.msgCB((geoMsg.CNTY,("-","-")))
                         with self.lock:
                             self.com.close()
-                            self.state = 1
+                            self.setState(1)
                     except:
                         # likely empty string so decode fails
                         pass
             
                     if self.wdCheck(5):
-                        self.log("Timeout waiting for GPS Date/Time sync, closing port")
+                        if self.isNetwork():
+                            self.log("Timeout waiting for GPS Date/Time sync, reopening port")
+                        else:
+                            self.log("Timeout waiting for GPS Date/Time sync, closing port")
                         with self.lock:
                             self.com.close()
-                            self.state = 0
+                            self.setState(1 if self.isNetwork() else 0)
 
             # State 4
             if self.state == 4:
-                self.in_state = 4
+                self.enterState(4)
                 self.log("Processing GPS data")
                 while self.state == 4 and not self._do_exit:
                     try:
-                        with self.lock:
-                            buf = self.com.readline().decode().rstrip()
-                        if buf:
+                        lines = self.readLines()
+                        while lines and self.state == 4:
+                            buf = lines.popleft()
                             self.logNMEA(buf)
-                   
-                            # process GPRMC lines for date/time        
-                            m = re.search('^\\$GPRMC', buf)
-                            if (m):
-                                try:
-                                    self.updateNmeaRmcDateTime(buf)
-                                except ValueError:
-                                    pass
-        
-                            # process GPGGA lines for location
-                            m = re.search('^\\$GPGGA', buf)
-                            if (m):
-                                changed = 0
-                                # Update time
-                                self.updateNmeaGgaTime(buf)
-                                
-                                # Extract decimal and find county/city
-                                try:
-                                    xy = self.getNmeaGgaCoords(buf)
-                                except ValueError:
-                                    continue
-                                
-                                grid = self.calcGridSquare(xy)
-                                self.msgCB((geoMsg.GRID,grid))
-                                if self.last_grid != grid:
-                                    # new grid detected
-                                    self.last_grid = grid
-                                    changed += 1
-                                
-                                qth = self.findCAIC(xy)
-                                self.msgCB((geoMsg.CNTY,(qth.name, qth.abbr)))
-                                if self.last_qth != qth.abbr:
-                                    # New county/city detected
-                                    self.last_qth = qth.abbr
-                                    changed += 2
-                                
-                                if changed: # or (self.gps_datetime - self.last_datetime) >= datetime.timedelta(seconds=30):
-                                    self.msgCB((geoMsg.NOTIF, changed))
-                                    self.last_datetime = self.gps_datetime
-                                    self.log("%s %s(%s)" % (grid, qth.name, qth.abbr))
-
-                                self.wdTick()
+                            self.processNmea(geoNmea.parse(buf))
                     except UnicodeDecodeError:
                         uniErrLimit -= 1
                         self.log("com data error! check baud rate")
@@ -437,14 +1819,14 @@ class arGeoDetector(Thread):
                         if uniErrLimit <= 0:
                             with self.lock:
                                 self.com.close()
-                                self.state = 0
+                                self.setState(0)
                     except serial.serialutil.SerialException as e:
                         self.log("com error [%s]" % (str(e)))
                         self.msgCB((geoMsg.GRID,"-"))
                         self.msgCB((geoMsg.CNTY,("-","-")))
                         with self.lock:
                             self.com.close()
-                            self.state = 1
+                            self.setState(1)
                     except:
                         print("empty string?")
                         # likely empty string so decode fails
@@ -453,80 +1835,215 @@ class arGeoDetector(Thread):
                     if self.wdCheck(2):
                         self.log("Timeout waiting for GPS location data, restarting lock sequence")
                         with self.lock:
-                            self.state = 2
+                            self.setState(2)
         
         # Clean up com if still open        
         if self.com.is_open:
             self.com.close()
             
+    def processNmea(self, rec):
+        # Act on one parsed sentence once date/time is synced, returns the
+        # change flags (1 grid, 2 county/city) of a GGA fix
+        if self.bset_next:
+            self.switchBoundaries()
+        
+        if type(rec) is geoNmeaRMC:
+            # RMC lines for date/time
+            try:
+                self.updateNmeaRmcDateTime(rec)
+                self.updateNmeaRmcMotion(rec)
+            except ValueError:
+                pass
+            return 0
+        if type(rec) is not geoNmeaGGA:
+            return 0
+        
+        # GGA lines for location
+        changed = 0
+        try:
+            # Update time
+            self.updateNmeaGgaTime(rec)
+            # Extract decimal and find county/city
+            xy = self.getNmeaGgaCoords(rec)
+        except ValueError:
+            return 0
+        
+        grid = self.calcGridSquare(xy)
+        self.msgCB((geoMsg.GRID,grid))
+        if self.last_grid != grid:
+            # new grid detected
+            self.last_grid = grid
+            changed += 1
+        
+        qth = self.routeCAIC(xy) or self.findCAIC(xy, grid)
+        self.msgCB((geoMsg.CNTY,(qth.name, qth.abbr)))
+        if self.last_qth != qth.abbr:
+            # New county/city detected
+            self.last_qth = qth.abbr
+            changed += 2
+        
+        if changed: # or (self.gps_datetime - self.last_datetime) >= datetime.timedelta(seconds=30):
+            self.msgCB((geoMsg.NOTIF, changed))
+            self.last_datetime = self.gps_datetime
+            self.log("%s %s(%s)" % (grid, qth.name, qth.abbr))
+
+        self.wdTick()
+        return changed
+    
+    def clone(self, cb, source=None, serial=None):
+        # Detector with its own fix state, watchdog and callback sharing the
+        # boundary set and route of this one
+        det = arGeoDetector(serial, cb, self.log_main, self.log_nmea)
+        for attr in ("bset", "route", "raster_res", "simplify_m", "grid_precision", "index_engine", "cache_dir", "mode"):
+            setattr(det, attr, getattr(self, attr))
+        det.source = source
+        return det
+    
+    def shareBoundaries(self, det):
+        # Adopt the boundary set and route of det, a detector processing
+        # fixes in another thread switches over before its next fix
+        self.bset_next = (det.bset, det.route)
+    
+    def switchBoundaries(self, bset_next=None):
+        # Swap in bset_next, or the pending set handed over by shareBoundaries
+        if bset_next is None:
+            (bset_next, self.bset_next) = (self.bset_next, None)
+            if bset_next is None:
+                return
+        (self.bset, self.route) = bset_next
+        self.overlaps = {}
+        self.qth_cache = None
+        self.next_cnty = None
+        self.route_on = False
+        self.route_seg = -1
+        self.index_queries = 0
+        self.index_time = 0.0
+    
     def replayFile(self, filename, speed = 0):
         self.log("Replaying {} NMEA GPS file".format(filename))
         with open(filename) as fp:
             for buf in fp:
                 #print(buf)
                 time.sleep(speed)
-                # process GPRMC lines for date/time        
-                m = re.search('^\\$GPRMC', buf)
-                if (m):
+                # process RMC lines for date/time        
+                rec = geoNmea.parseLogged(buf, self.replay_source)
+                if type(rec) is geoNmeaRMC:
                     try:
-                        self.updateNmeaRmcDateTime(buf)
+                        self.updateNmeaRmcDateTime(rec)
+                        self.updateNmeaRmcMotion(rec)
                     except ValueError:
                         pass
-                # process GPGGA lines
-                m = re.search('^\\$GPGGA', buf)
-                if (m):
+                # process GGA lines
+                elif type(rec) is geoNmeaGGA:
                     try:
-                        xy = self.getNmeaGgaCoords(buf)
+                        xy = self.getNmeaGgaCoords(rec)
                     except ValueError:
                         continue
                     grid = self.calcGridSquare(xy)
-                    qth = self.findCAIC(xy)
+                    qth = self.routeCAIC(xy) or self.findCAIC(xy, grid)
                     self.msgCB((geoMsg.GRID,grid))
                     self.msgCB((geoMsg.CNTY,(qth.name, qth.abbr)))
                     self.log("%s %s(%s)" % (grid, qth.name, qth.abbr))
         self.log("Replay complete")
+        self.log(self.index.report(self.index_queries, self.index_time))
         self.msgCB((geoMsg.REPLAY,0))
             
     # Sync datetime on RMC strings
-    def updateNmeaRmcDateTime(self, nmea_str):
+    def updateNmeaRmcDateTime(self, rmc):
         #$GPRMC,154007.00,A,3835.17128,N,07745.57692,W,0.070,,220319,,,A*67
-        nmea_fields = nmea_str.split(',')
-        if not nmea_fields[1][:2]:
+        if not rmc.time[:2]:
             raise ValueError("RMC record does not contain valid date and time")
-        h = int(nmea_fields[1][:2])
-        m = int(nmea_fields[1][2:4])
-        s = int(nmea_fields[1][4:6])
-        D = int(nmea_fields[9][:2])
-        M = int(nmea_fields[9][2:4])
-        Y = 2000 + int(nmea_fields[9][4:6])
+        h = int(rmc.time[:2])
+        m = int(rmc.time[2:4])
+        s = int(rmc.time[4:6])
+        D = int(rmc.date[:2])
+        M = int(rmc.date[2:4])
+        Y = 2000 + int(rmc.date[4:6])
         self.gps_datetime = datetime.datetime(Y,M,D,h,m,s,tzinfo=datetime.timezone.utc)
         self.gps_lock = True
         self.msgCB((geoMsg.TIME, self.gps_datetime.strftime("%Y/%m/%d %H:%M:%S %Z")))
         
+    # Predict crossings from RMC position, speed and course
+    def updateNmeaRmcMotion(self, rmc):
+        #$GPRMC,154007.00,A,3835.17128,N,07745.57692,W,0.070,,220319,,,A*67
+        if rmc.status != 'A' or not rmc.lat:
+            raise ValueError("RMC record does not contain a valid fix")
+        xy = self.nmeaCoords(rmc.lat, rmc.lat_d, rmc.lon, rmc.lon_d)
+        knots = float(rmc.knots or 0)
+        self.last_knots = knots
+        if self.route_on:
+            # the planned route already publishes the next crossings
+            return
+        if knots < PREDICT_MIN_KNOTS or not rmc.course:
+            # heading is meaningless when stopped, the nearest grid line is
+            # shown instead
+            if self.next_moving:
+                self.next_moving = False
+                self.msgCB((geoMsg.NEXT, (geoMsg.CNTY, None, None, "")))
+            (d, grid) = self.nearestGridEdge(xy)
+            self.msgCB((geoMsg.NEXT, (geoMsg.GRID, d, None, grid)))
+            return
+        self.next_moving = True
+        self.predictCrossing(xy, float(rmc.course), knots)
+    
+    def predictCrossing(self, xy, course, knots):
+        # Cast a ray along the course and publish distance and ETA to the
+        # next county/city line and the next grid subsquare line
+        (x,y) = xy
+        mps = knots * 0.514444
+        kx = math.cos(math.radians(y))
+        dx = math.sin(math.radians(course)) / kx
+        dy = math.cos(math.radians(course))
+        
+        hit = self.edge_index.castRay(xy, course, PREDICT_RANGE_M / DEG_M)
+        if hit:
+            (d, bnd, e) = hit
+            if not self.next_cnty or self.next_cnty[:2] != (bnd.id, e):
+                # classify a point just across the line once per edge
+                d2 = d + 5 / DEG_M
+                qth = self.matchCAIC((x + dx*d2, y + dy*d2))
+                self.next_cnty = (bnd.id, e, qth.abbr if qth else "UNK")
+            self.msgCB((geoMsg.NEXT, (geoMsg.CNTY, d * DEG_M, d * DEG_M / mps, self.next_cnty[2])))
+        else:
+            self.msgCB((geoMsg.NEXT, (geoMsg.CNTY, None, None, "")))
+        
+        # leave the current locator through whichever side comes first
+        self.calcGridSquare(xy)
+        (x0, y0, x1, y1) = self.grid_cache[6]
+        tx = ((x1 if dx > 0 else x0) - x) / dx if dx else math.inf
+        ty = ((y1 if dy > 0 else y0) - y) / dy if dy else math.inf
+        d = min(tx, ty)
+        d2 = d + 5 / DEG_M
+        grid = self.gridLocator((x + dx*d2, y + dy*d2), self.grid_precision)[0]
+        self.msgCB((geoMsg.NEXT, (geoMsg.GRID, d * DEG_M, d * DEG_M / mps, grid)))
+    
     # Sync location on GGA strings
-    def updateNmeaGgaTime(self, nmea_str):
+    def updateNmeaGgaTime(self, gga):
         # Form: $GPGGA,002852.00,3835.14680,N,07745.58318,W,1,03,5.60,127.9,M,-34.5,M,,*61
-        nmea_fields = nmea_str.split(',')
-        if not nmea_fields[1][:2]:
+        if not gga.time[:2]:
             raise ValueError("GGA record does not contain valid time")
-        h = int(nmea_fields[1][:2])
-        m = int(nmea_fields[1][2:4])
-        s = int(nmea_fields[1][4:6])
+        h = int(gga.time[:2])
+        m = int(gga.time[2:4])
+        s = int(gga.time[4:6])
         self.gps_datetime.replace(hour=h, minute=m, second=s)
         self.msgCB((geoMsg.TIME, self.gps_datetime.strftime("%Y/%m/%d %H:%M:%S %Z")))
     
-    def getNmeaGgaCoords(self, nmea_str):
+    def getNmeaGgaCoords(self, gga, notify=True):
         # Form: $GPGGA,002852.00,3835.14680,N,07745.58318,W,1,03,5.60,127.9,M,-34.5,M,,*61
-        nmea_fields = nmea_str.split(',')
-        if not nmea_fields[2]:
+        if not gga.lat:
             raise ValueError("GGA record does not contain valid coordinates")
              #           return (0,0)
         
-        nmea_y = nmea_fields[2]
-        nmea_yd = nmea_fields[3]
-        nmea_x = nmea_fields[4]
-        nmea_xd = nmea_fields[5]
+        (nmea_y, nmea_yd, nmea_x, nmea_xd) = (gga.lat, gga.lat_d, gga.lon, gga.lon_d)
+        (x,y) = self.nmeaCoords(nmea_y, nmea_yd, nmea_x, nmea_xd)
         
+        if notify:
+            self.msgCB((geoMsg.GPS, "%s%s  %s%s" % (nmea_y,nmea_yd,nmea_x,nmea_xd)))
+#        print ("NMEA(LON:%f,LAT:%f) " % (x, y), end='')
+        return (x,y)
+    
+    def nmeaCoords(self, nmea_y, nmea_yd, nmea_x, nmea_xd):
+        # Form: 3835.14680,N,07745.58318,W
         y = float(nmea_y[0:2]) + (float(nmea_y[2:])/60.0)
         if nmea_yd == 'S':
             y = 0 - y
@@ -534,52 +2051,213 @@ class arGeoDetector(Thread):
         x = float(nmea_x[0:3]) + (float(nmea_x[3:])/60.0)
         if nmea_xd == 'W':
             x = 0 - x
-        
-        self.msgCB((geoMsg.GPS, "%s%s  %s%s" % (nmea_y,nmea_yd,nmea_x,nmea_xd)))
-#        print ("NMEA(LON:%f,LAT:%f) " % (x, y), end='')
         return (x,y)
     
-    def findCAIC(self, xy):
+    def loadRoute(self, filename):
+        # Plan a GPX/KML/NMEA route against the loaded boundaries
+        start = time.perf_counter()
+        try:
+            points = geoRoute.readPoints(filename, self)
+        except (OSError, ValueError, xml.etree.ElementTree.ParseError) as e:
+            self.log("Unable to read route %s: %s" % (filename, e))
+            return False
+        if len(points) < 2:
+            self.log("Route %s has no usable points" % filename)
+            return False
+        route = geoRoute(points)
+        route.plan(self)
+        self.route_on = False
+        self.route_seg = -1
+        self.route = route
+        self.log("Route planned in %.1f ms: %d points, %.1f km, %d county/city and %d grid crossings" % (
+            (time.perf_counter() - start) * 1e3, len(points), route.along[-1] / 1000,
+            len(route.crossings[geoMsg.CNTY]), len(route.crossings[geoMsg.GRID])))
+        return True
+    
+    def routeCAIC(self, xy):
+        # County/city from the planned route, None when off the route or too
+        # close to a line to tell, findCAIC answers those.  A route planned
+        # against another boundary set is not used.
+        if not self.route or self.route.bset is not self.bset:
+            return None
+        hit = self.route.lookup(xy, self.route_seg)
+        if hit is None:
+            if self.route_on:
+                self.route_on = False
+                self.log("Left planned route")
+            return None
+        if not self.route_on:
+            self.route_on = True
+            self.next_moving = True
+            self.log("On planned route")
+        (qid, along, self.route_seg) = hit
+        
+        mps = self.last_knots * 0.514444
+        for ctype in (geoMsg.CNTY, geoMsg.GRID):
+            nxt = self.route.nextCrossing(along, ctype)
+            if nxt:
+                eta = nxt[0] / mps if self.last_knots >= PREDICT_MIN_KNOTS else None
+                self.msgCB((geoMsg.NEXT, (ctype, nxt[0], eta, nxt[1])))
+            else:
+                self.msgCB((geoMsg.NEXT, (ctype, None, None, "")))
+        
+        if qid is None:
+            return None
+        if qid == CELL_UNKNOWN:
+            return self.unknownCAIC()
+        if not 0 <= qid < len(self.boundaries):
+            return None
+        return self.boundaries[qid]
+    
+    def findCAIC(self, xy, grid=None):
         (nx,ny) = xy
         
         # return if bogus data
         if nx == 0 and ny == 0:
             return
         
-        qth_list = []
-        for bnd in self.boundaries:
-            if bnd.contains(xy):
-                qth_list.append(bnd)
+        # Reuse the previous result while the fix is closer to the cached
+        # fix than to any boundary edge, no line can have been crossed.
+        # The set check drops a result a lookup racing with a reload
+        # stored after the new set was swapped in.
+        if self.qth_cache:
+            (cx,cy,kx,radius,qth,bset) = self.qth_cache
+            if bset is self.bset and math.hypot((nx-cx)*kx, ny-cy) < radius:
+                return qth
+        
+        # Raster and subsquare cells without a line through them answer
+        # directly, cells with an edge fall through to the polygon tests
+        if self.raster:
+            c = self.raster.cellOf(xy)
+            value = self.raster.cells[c] if c >= 0 else CELL_EDGE
+            if value >= 0:
+                self.bnd_warn = 0
+                return self.boundaries[value]
+            elif value == CELL_UNKNOWN:
+                return self.unknownCAIC()
         
+        if self.subsquares:
+            if grid is None:
+                grid = self.calcGridSquare(xy)
+            value = self.subsquares.get(grid[:6], CELL_EDGE)
+            if value >= 0:
+                self.bnd_warn = 0
+                return self.boundaries[value]
+            elif value == CELL_UNKNOWN:
+                return self.unknownCAIC()
+        
+        qth = self.lookupCAIC(xy)
+        kx = math.cos(math.radians(ny))
+        radius = self.safeRadius(xy, kx)
+        # not worth keeping when about one second of travel leaves it, nor
+        # without any boundaries to measure against
+        if radius is not None and radius * DEG_M > max(SAFE_MIN_M, self.last_knots * 0.514444):
+            self.qth_cache = (nx, ny, kx, radius, qth, self.bset)
+        else:
+            self.qth_cache = None
+        return qth
+    
+    def safeRadius(self, xy, kx):
+        # Distance to the nearest edge of any boundary up to SAFE_RADIUS_M,
+        # only the edge lattice cells around xy are searched.  None without
+        # boundaries.
+        return self.edge_index.nearestEdge(xy, kx, SAFE_RADIUS_M / DEG_M)
+    
+    def lookupCAIC(self, xy):
+        qth = self.matchCAIC(xy)
+        if qth is None:
+            return self.unknownCAIC()
+        self.bnd_warn = 0
+        return qth
+    
+    def unknownCAIC(self):
+        if self.bnd_warn == 0:
+            print ("Warning: coordinate did not match boundary file")
+            self.bnd_warn = 1
+        return  geoBoundary("Unknown", "UNK")
+    
+    def queryIndex(self, xy):
+        t = time.perf_counter()
+        cands = self.index.query(xy)
+        self.index_time += time.perf_counter() - t
+        self.index_queries += 1
+        return cands
+    
+    def matchCAIC(self, xy):
+        # Full polygon lookup, None when no boundary matches
+        cands = self.queryIndex(xy)
+        qth_list = [b for (b,inside) in zip(cands, geoBoundary.containsMany(xy, cands)) if inside]
+        return self.resolveCAIC(qth_list)
+    
+    def resolveCAIC(self, qth_list):
         # If more than one boundaries match, solve for correct boundary
         # 1) city and county, find city in county
         # 2) county/county overlap, just pick one
+        # The pairwise containment comes from the nesting table built at
+        # load time and each combination is only resolved once
+        if not qth_list:
+            return None
+        
         qth = False
         if len(qth_list) == 1:
             qth = qth_list[0]
-        elif len(qth_list) > 1:
-            for i in range(0,len(qth_list)):
-                for j in range(0, len(qth_list)):
-                    if i != j:
-                        #print ("%s vs %s" % (qth_list[i].abbr, qth_list[j].abbr))
-                        c = qth_list[j].coords[0]
-                        if not qth_list[i].contains(c):
-                            qth = qth_list[i]
         else:
-            if self.bnd_warn == 0:
-                print ("Warning: coordinate did not match boundary file")
-                self.bnd_warn = 1
-            return  geoBoundary("Unknown", "UNK")
+            key = tuple(b.id for b in qth_list)
+            qth = self.overlaps.get(key)
+            if qth is None:
+                for i in range(0,len(qth_list)):
+                    for j in range(0, len(qth_list)):
+                        if i != j:
+                            #print ("%s vs %s" % (qth_list[i].abbr, qth_list[j].abbr))
+                            if qth_list[j].id not in self.nesting[qth_list[i].id]:
+                                qth = qth_list[i]
+                self.overlaps[key] = qth
 
         if not qth:
             qth = qth_list[0]
-            
-        self.bnd_warn = 0
         return qth
             
         #print ("QTH> %s" % (qth.abbr))
 
-    def calcGridSquare(self, xy):
+    def calcGridSquare(self, xy, precision=None):
+        # Locator of grid_precision characters.  The bounds of the last
+        # locator are kept, shrunk by CELL_EPS so float rounding right on a
+        # line always takes the full computation, and fixes inside them
+        # return the cached string.
+        if precision is None:
+            precision = self.grid_precision
+        (x, y) = xy
+        cache = self.grid_cache
+        if cache and cache[0] == precision and cache[1] < x < cache[3] and cache[2] < y < cache[4]:
+            return cache[5]
+        
+        (grid, (x0, y0, x1, y1)) = self.gridLocator(xy, precision)
+        self.grid_cache = (precision, x0 + CELL_EPS, y0 + CELL_EPS, x1 - CELL_EPS, y1 - CELL_EPS, grid, (x0, y0, x1, y1))
+        return grid
+    
+    def nearestGridEdge(self, xy):
+        # Meters from xy to the nearest edge of its locator and the locator
+        # just across that edge
+        self.calcGridSquare(xy)
+        (x0, y0, x1, y1) = self.grid_cache[6]
+        (x, y) = xy
+        kx = math.cos(math.radians(y))
+        step = 5 / DEG_M
+        (d, across) = min((((x - x0) * kx, (x0 - step / kx, y)), ((x1 - x) * kx, (x1 + step / kx, y)),
+                           (y - y0, (x, y0 - step)), (y1 - y, (x, y1 + step))), key=lambda side: side[0])
+        return (max(0.0, d) * DEG_M, self.gridLocator(across, self.grid_precision)[0])
+    
+    @staticmethod
+    def gridSize(precision=6):
+        # Width and height in degrees of a locator of precision characters
+        (w, h) = (2/24, 1/24)
+        for div in (10, 24)[:(precision - 6) // 2]:
+            (w, h) = (w / div, h / div)
+        return (w, h)
+    
+    @staticmethod
+    def gridLocator(xy, precision=6):
+        # Maidenhead locator of 6, 8 or 10 characters and its corners
         (nx, ny) = xy
         
         # move origin to bottom left of the world 
@@ -609,8 +2287,627 @@ class arGeoDetector(Thread):
         # convert to ascii capitals A-R
         xssc = str(chr(97 + xss))
         yssc = str(chr(97 + yss))
+        
+        grid = "%s%s%s%s%s%s" % (xfc, yfc, xsc, ysc,xssc,yssc)
+        (w, h) = (2/24, 1/24)
+        x0 = xf*20 + xs*2 + xss*w - 180
+        y0 = yf*10 + ys + yss*h - 90
+        
+        # extended square is a 10x10 split of the subsquare, extended
+        # subsquare a 24x24 split of that, clamped against float rounding
+        for (div, base) in ((10, 48), (24, 97))[:(precision - 6) // 2]:
+            (w, h) = (w / div, h / div)
+            xe = min(div - 1, max(0, math.floor((xy[0] - x0) / w)))
+            ye = min(div - 1, max(0, math.floor((xy[1] - y0) / h)))
+            grid += chr(base + xe) + chr(base + ye)
+            x0 += xe * w
+            y0 += ye * h
+        return (grid, (x0, y0, x0 + w, y0 + h))
+
+    def findCAICBatch(self, coords):
+        # Classify many coordinates at once.  Points sharing the same index
+        # candidates are tested together with the vectorized kernel.
+        if np is None:
+            return [self.findCAIC(xy) for xy in coords]
+        
+        res = [None] * len(coords)
+        groups = {}
+        for (k,xy) in enumerate(coords):
+            if xy[0] == 0 and xy[1] == 0:
+                continue
+            cands = self.queryIndex(xy)
+            grp = groups.setdefault(tuple(b.id for b in cands), (cands, []))
+            grp[1].append(k)
+        
+        for (cands, pts) in groups.values():
+            px = np.array([coords[k][0] for k in pts], dtype=float)
+            py = np.array([coords[k][1] for k in pts], dtype=float)
+            inside = [bnd.containsPoints(px, py).tolist() for bnd in cands]
+            for (n,k) in enumerate(pts):
+                res[k] = self.resolveCAIC([bnd for (c,bnd) in enumerate(cands) if inside[c][n]]) or self.unknownCAIC()
+        return res
+    
+    def calcGridSquareBatch(self, coords, precision=None):
+        if precision is None:
+            precision = self.grid_precision
+        if np is None or precision != 6:
+            return [self.gridLocator(xy, precision)[0] for xy in coords]
+        
+        pts = np.array(coords, dtype=float).reshape(-1, 2)
+        nx = pts[:,0] + 180
+        ny = pts[:,1] + 90
+        xf = np.floor(nx / 20)
+        yf = np.floor(ny / 10)
+        xs = np.floor((nx-(xf*20)) / 2)
+        ys = np.floor((ny-(yf*10)) / 1)
+        xss = np.floor((nx-(xf*20)-(xs*2)) / (2/24))
+        yss = np.floor((ny-(yf*10)-(ys*1)) / (1/24))
+        
+        return ["%s%s%d%d%s%s" % (chr(65 + a), chr(65 + b), c, d, chr(97 + e), chr(97 + f))
+                for (a,b,c,d,e,f) in zip(*(v.astype(int).tolist() for v in (xf, yf, xs, ys, xss, yss)))]
+    
+    def classify(self, coords):
+        # Batch grid square and county/city lookup, returns (grid, qth) pairs
+        return list(zip(self.calcGridSquareBatch(coords), self.findCAICBatch(coords)))
+    
+    def classifyFile(self, filename, outfile):
+        # Post process a captured NMEA log into a CSV of grid and county/city
+        self.log("Classifying {} NMEA GPS file".format(filename))
+        times = []
+        coords = []
+        with open(filename) as fp:
+            for buf in fp:
+                rec = geoNmea.parseLogged(buf, self.replay_source)
+                if type(rec) is not geoNmeaGGA:
+                    continue
+                try:
+                    coords.append(self.getNmeaGgaCoords(rec, notify=False))
+                except ValueError:
+                    continue
+                times.append(rec.time)
+        
+        with open(outfile, "w") as fp:
+            fp.write("time,lat,lon,grid,abbr,name\n")
+            for (t,xy,(grid,qth)) in zip(times, coords, self.classify(coords)):
+                if qth is None:
+                    continue
+                fp.write("%s,%.6f,%.6f,%s,%s,%s\n" % (t, xy[1], xy[0], grid, qth.abbr, qth.name))
+        self.log("Classified %d fixes into %s" % (len(coords), outfile))
+
+class geoNetPort():
+    # Network NMEA source offering the parts of the serial.Serial interface
+    # the detector uses.  tcp://host:port connects to a server sending
+    # NMEA (phone GPS forwarders), gpsd://host:port connects to gpsd and
+    # asks it for NMEA, tcp-listen://[host]:port takes one client at a
+    # time and udp://[host]:port receives datagrams.  read()
+    # returns whatever has arrived, up to NET_READ_SIZE bytes, within the
+    # timeout, so the bulk reader gets a whole burst per call.
+    SCHEMES = ("tcp", "gpsd", "tcp-listen", "udp")
+    
+    def __init__(self, spec, timeout=1):
+        (self.scheme, self.host, self.tcp_port) = geoNetPort.parseSpec(spec)
+        self.port = spec
+        self.baudrate = self.scheme
+        self.timeout = timeout
+        self.is_open = False
+        self.sock = None # connected or bound data socket
+        self.server = None # listening socket
+        self.sel = None
+        self.wake = None # socket pair interrupting a blocked read
+    
+    @staticmethod
+    def parseSpec(spec):
+        # (scheme, host, port) of a network input spec, ValueError if not one
+        (scheme, sep, addr) = spec.partition("://")
+        (host, _, port) = addr.rpartition(':')
+        if not sep or scheme not in geoNetPort.SCHEMES or not port.isdigit():
+            raise ValueError("not a network input [%s]" % spec)
+        host = host.strip("[]")
+        if scheme in ("tcp", "gpsd") and not host:
+            host = "localhost"
+        return (scheme, host, int(port))
+    
+    def open(self):
+        try:
+            if self.scheme in ("tcp", "gpsd"):
+                self.sock = socket.create_connection((self.host, self.tcp_port), self.timeout)
+                if self.scheme == "gpsd":
+                    self.sock.sendall(GPSD_WATCH)
+            elif self.scheme == "tcp-listen":
+                self.server = socket.socket(socket.AF_INET6 if ':' in self.host else socket.AF_INET)
+                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.server.bind((self.host, self.tcp_port))
+                self.server.listen(1)
+            else:
+                self.sock = socket.socket(socket.AF_INET6 if ':' in self.host else socket.AF_INET, socket.SOCK_DGRAM)
+                self.sock.bind((self.host, self.tcp_port))
+        except OSError as e:
+            self.close()
+            raise serial.serialutil.SerialException("could not open %s: %s" % (self.port, e))
+        
+        self.wake = socket.socketpair()
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.wake[0], selectors.EVENT_READ)
+        for sock in (self.sock, self.server):
+            if sock:
+                sock.setblocking(False)
+                self.sel.register(sock, selectors.EVENT_READ)
+        self.is_open = True
+    
+    def close(self):
+        self.is_open = False
+        if self.sel:
+            self.sel.close()
+            self.sel = None
+        for sock in (self.sock, self.server) + (self.wake or ()):
+            if sock:
+                sock.close()
+        (self.sock, self.server, self.wake) = (None, None, None)
+    
+    @property
+    def in_waiting(self):
+        # unknown without reading, read() returns everything anyway
+        return 0
+    
+    def cancel_read(self):
+        if self.wake:
+            self.wake[1].send(b'\0')
+    
+    def read(self, size=1):
+        if not self.is_open:
+            raise serial.serialutil.SerialException("port not open")
+        try:
+            for (key, _) in self.sel.select(self.timeout):
+                if key.fileobj is self.wake[0]:
+                    self.wake[0].recv(64)
+                    return b''
+                if key.fileobj is self.server:
+                    # a new client replaces the current one
+                    (client, _) = self.server.accept()
+                    self.dropClient()
+                    client.setblocking(False)
+                    self.sock = client
+                    self.sel.register(client, selectors.EVENT_READ)
+                    continue
+                if self.scheme == "udp":
+                    return self.readDatagrams()
+                data = self.sock.recv(max(size, NET_READ_SIZE))
+                if data:
+                    return data
+                if self.server:
+                    # client went away, wait for the next one
+                    self.dropClient()
+                    return b''
+                raise serial.serialutil.SerialException("connection closed [%s]" % self.port)
+        except OSError as e:
+            raise serial.serialutil.SerialException("%s [%s]" % (e, self.port))
+        return b''
+    
+    def readDatagrams(self):
+        # every datagram already queued, up to NET_READ_SIZE bytes
+        chunks = []
+        total = 0
+        while total < NET_READ_SIZE:
+            try:
+                data = self.sock.recv(NET_READ_SIZE)
+            except BlockingIOError:
+                break
+            chunks.append(geoNetPort.datagram(data))
+            total += len(data)
+        return b''.join(chunks)
+    
+    @staticmethod
+    def datagram(data):
+        # a datagram always ends its last line
+        return data if data.endswith(b'\n') else data + b'\r\n'
+    
+    def dropClient(self):
+        if self.sock:
+            self.sel.unregister(self.sock)
+            self.sock.close()
+            self.sock = None
+
+class geoDatagramFeed(asyncio.DatagramProtocol):
+    # Feeds received datagrams into a StreamReader
+    def __init__(self, reader):
+        self.reader = reader
+    
+    def datagram_received(self, data, addr):
+        self.reader.feed_data(geoNetPort.datagram(data))
+
+class geoAsyncDetector():
+    # asyncio counterpart of the arGeoDetector serial thread.  Every input
+    # is a coroutine reading its stream in bulk and running the sentences
+    # through its own clone of det, so all inputs share the loaded
+    # boundaries.  Messages are queued as (input, msg) and one dispatcher
+    # coroutine hands them to the sinks.  One event loop serves any number
+    # of inputs without a thread per source.
+    def __init__(self, det, baudrate=4800):
+        self.det = det
+        self.baudrate = baudrate
+        self.sinks = []
+        self.detectors = {} # input spec -> detector
+        self.queue = None
+    
+    def addSink(self, cb):
+        # cb(input, msg) is called on the event loop for every message
+        self.sinks.append(cb)
+    
+    async def openInput(self, spec):
+        # A geoNetPort style network spec or a serial device path, a pty
+        # works as well.  Returns (StreamReader, close function).
+        loop = asyncio.get_running_loop()
+        scheme = self.scheme(spec)
+        if scheme in ("tcp", "gpsd"):
+            (_, host, port) = geoNetPort.parseSpec(spec)
+            (reader, writer) = await asyncio.open_connection(host, port, limit=NET_READ_SIZE)
+            if scheme == "gpsd":
+                writer.write(GPSD_WATCH)
+            return (reader, writer.close)
+        
+        if scheme == "tcp-listen":
+            (_, host, port) = geoNetPort.parseSpec(spec)
+            reader = asyncio.StreamReader()
+            clients = []
+            async def client(r, w):
+                # a new client replaces the current one
+                while clients:
+                    clients.pop().close()
+                clients.append(w)
+                try:
+                    while True:
+                        data = await r.read(NET_READ_SIZE)
+                        if not data:
+                            break
+                        reader.feed_data(data)
+                except ConnectionError:
+                    pass
+                finally:
+                    w.close()
+            server = await asyncio.start_server(client, host or None, port)
+            def close():
+                server.close()
+                while clients:
+                    clients.pop().close()
+            return (reader, close)
+        
+        if scheme == "udp":
+            (_, host, port) = geoNetPort.parseSpec(spec)
+            reader = asyncio.StreamReader()
+            (transport, _) = await loop.create_datagram_endpoint(lambda: geoDatagramFeed(reader), local_addr=(host or "0.0.0.0", port))
+            return (reader, transport.close)
+        
+        com = serial.Serial(spec, baudrate=self.baudrate, timeout=0)
+        reader = asyncio.StreamReader()
+        if hasattr(com, "fileno"):
+            fp = open(com.fileno(), 'rb', buffering=0, closefd=False)
+            (transport, _) = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), fp)
+            def close():
+                transport.close()
+                com.close()
+            return (reader, close)
+        
+        # no pollable descriptor on Windows, bulk reads in a worker thread
+        com.timeout = 1
+        def pump():
+            while com.is_open:
+                try:
+                    data = com.read(max(1, com.in_waiting))
+                except serial.serialutil.SerialException as e:
+                    loop.call_soon_threadsafe(reader.set_exception, e)
+                    return
+                if data:
+                    loop.call_soon_threadsafe(reader.feed_data, data)
+        loop.run_in_executor(None, pump)
+        def close():
+            com.cancel_read()
+            com.close()
+        return (reader, close)
+    
+    @staticmethod
+    def scheme(spec):
+        try:
+            return geoNetPort.parseSpec(spec)[0]
+        except ValueError:
+            return None
+    
+    async def readInput(self, spec):
+        # Network inputs reconnect with a doubling backoff, a serial input
+        # ends when its device goes away
+        det = self.det.clone(lambda msg: self.queue.put_nowait((spec, msg)), spec)
+        self.detectors[spec] = det
+        network = self.scheme(spec) is not None
+        retry = RETRY_MIN
+        while True:
+            try:
+                (reader, close) = await self.openInput(spec)
+            except OSError as e:
+                if not network:
+                    raise
+                det.log("Error opening input: %s" % e)
+            else:
+                if await self.processInput(det, reader, close):
+                    # the backoff starts over once data has arrived
+                    retry = RETRY_MIN
+                if not network:
+                    det.log("Input closed")
+                    return
+                det.log("Input closed, reconnecting")
+            await asyncio.sleep(retry)
+            retry = min(NET_RETRY_MAX, retry * 2)
+    
+    async def processInput(self, det, reader, close):
+        # True if any data arrived before the input closed.  Like state 3
+        # of the thread, fixes are only processed once an RMC sentence has
+        # set the date and time of this connection.
+        det.log("Waiting for GPS Date/Time sync")
+        buf = bytearray()
+        lines = deque()
+        received = False
+        synced = False
+        try:
+            while True:
+                try:
+                    data = await reader.read(NET_READ_SIZE)
+                except ConnectionError:
+                    break
+                if not data:
+                    break
+                received = True
+                buf += data
+                if geoNmea.frame(buf, lines):
+                    det.log("com data error! check baud rate")
+                while lines:
+                    line = lines.popleft()
+                    det.logNMEA(line)
+                    rec = geoNmea.parse(line)
+                    if not synced:
+                        if type(rec) is not geoNmeaRMC:
+                            continue
+                        try:
+                            det.updateNmeaRmcDateTime(rec)
+                        except ValueError:
+                            continue
+                        synced = True
+                        det.log("Date/Time synced!")
+                        det.log("Processing GPS data")
+                        continue
+                    det.processNmea(rec)
+        finally:
+            close()
+        return received
+    
+    async def dispatch(self):
+        while True:
+            (spec, msg) = await self.queue.get()
+            for cb in self.sinks:
+                cb(spec, msg)
+            self.queue.task_done()
+    
+    async def run(self, specs):
+        # Process all inputs until they end or the task is cancelled
+        self.queue = asyncio.Queue()
+        dispatcher = asyncio.create_task(self.dispatch())
+        try:
+            results = await asyncio.gather(*(self.readInput(spec) for spec in specs), return_exceptions=True)
+            for (spec, res) in zip(specs, results):
+                if isinstance(res, Exception):
+                    self.det.log("Input failed [%s]: %s" % (spec, res))
+            await self.queue.join()
+        finally:
+            dispatcher.cancel()
+
+class geoSubscriber():
+    # One consumer of the event bus with its own bounded queue and delivery
+    # thread.  "drop-oldest" keeps the newest maxlen events, "coalesce" in
+    # addition replaces a queued state or status event by a newer one of
+    # its kind.  Change alerts and replay completion are never dropped.
+    POLICIES = ("drop-oldest", "coalesce")
+    
+    def __init__(self, cb, name, maxlen, policy):
+        if policy not in geoSubscriber.POLICIES:
+            raise ValueError("unknown event bus policy [%s]" % policy)
+        self.cb = cb
+        self.name = name
+        self.maxlen = maxlen
+        self.policy = policy
+        self.queue = OrderedDict() # key -> (publish time, msg)
+        self.seq = 0 # keys of events that are never coalesced
+        self.cond = threading.Condition()
+        self.closed = False
+        
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.lagging = 0 # delivered more than BUS_LAG_S after publishing
+        self.max_lag = 0.0
+        
+        self.thread = Thread(target=self.deliver, name="bus-%s" % name, daemon=True)
+        self.thread.start()
+    
+    def put(self, msg):
+        # Never blocks beyond the queue lock
+        key = geoEventBus.coalesceKey(msg) if self.policy == "coalesce" else None
+        with self.cond:
+            self.published += 1
+            if key is None:
+                key = self.seq
+                self.seq += 1
+            elif key in self.queue:
+                del self.queue[key]
+                self.coalesced += 1
+            self.queue[key] = (time.monotonic(), msg)
+            if len(self.queue) > self.maxlen:
+                for (k,(_,m)) in self.queue.items():
+                    if not geoEventBus.mustDeliver(m):
+                        del self.queue[k]
+                        self.dropped += 1
+                        break
+            self.cond.notify()
+    
+    def deliver(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.queue or self.closed)
+                if not self.queue:
+                    return
+                (_, (t, msg)) = self.queue.popitem(last=False)
+            lag = time.monotonic() - t
+            self.max_lag = max(self.max_lag, lag)
+            if lag > BUS_LAG_S:
+                self.lagging += 1
+            try:
+                self.cb(msg)
+            except Exception:
+                traceback.print_exc()
+            self.delivered += 1
+    
+    def close(self):
+        # Deliver what is queued, then end the delivery thread
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+    
+    def report(self):
+        return "%s %d delivered, %d dropped, %d coalesced, %d lagging, max lag %.1f ms" % (
+            self.name, self.delivered, self.dropped, self.coalesced, self.lagging, self.max_lag * 1e3)
+
+class geoEventBus():
+    # Fans detector messages out to subscribers.  publish() only queues, so
+    # the serial and lookup path never waits for a slow consumer.
+    def __init__(self):
+        self.subscribers = []
+    
+    @staticmethod
+    def stateKey(msg):
+        # Kind of a message describing current state, None for events
+        (t,s) = msg
+        if t in (geoMsg.GRID, geoMsg.CNTY, geoMsg.GPS, geoMsg.TIME):
+            return t
+        if t == geoMsg.NEXT:
+            return (t, s[0])
+        return None
+    
+    @staticmethod
+    def coalesceKey(msg):
+        # Kind a coalescing subscriber keeps only the latest of, status
+        # lines as well since only the last one is shown
+        if msg[0] == geoMsg.STAT:
+            return geoMsg.STAT
+        return geoEventBus.stateKey(msg)
+    
+    @staticmethod
+    def mustDeliver(msg):
+        # Events a full queue never drops, losing a change alert defeats
+        # the purpose and a lost REPLAY leaves the port closed
+        return msg[0] in (geoMsg.NOTIF, geoMsg.REPLAY)
+    
+    def subscribe(self, cb, name, maxlen=BUS_QUEUE_LEN, policy="drop-oldest"):
+        sub = geoSubscriber(cb, name, maxlen, policy)
+        # replaced rather than appended so publish() needs no lock
+        self.subscribers = self.subscribers + [sub]
+        return sub
+    
+    def unsubscribe(self, sub):
+        self.subscribers = [s for s in self.subscribers if s is not sub]
+        sub.close()
+    
+    def publish(self, msg):
+        for sub in self.subscribers:
+            sub.put(msg)
+    
+    def close(self, timeout=1):
+        # Give every subscriber up to timeout seconds to drain its queue
+        for sub in self.subscribers:
+            sub.close()
+        for sub in self.subscribers:
+            sub.thread.join(timeout)
+    
+    def report(self):
+        return "Event bus: " + "; ".join(sub.report() for sub in self.subscribers)
+
+class geoNmeaLogHandler(logging.handlers.BaseRotatingHandler):
+    # NMEA session log, run on a QueueListener thread.  Sentences collect in
+    # a large file buffer written out every NMEA_LOG_FLUSH_S, the file rolls
+    # over by size or age and closed segments can be gzipped.
+    def __init__(self, filename, maxBytes=NMEA_LOG_MAX_BYTES, maxAge=NMEA_LOG_MAX_AGE_S,
+                 backupCount=NMEA_LOG_BACKUPS, compress=NMEA_LOG_COMPRESS):
+        logging.handlers.BaseRotatingHandler.__init__(self, filename, 'a', delay=True)
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.backupCount = backupCount
+        if os.path.exists(self.baseFilename):
+            self.size = os.path.getsize(self.baseFilename)
+            self.opened = os.path.getmtime(self.baseFilename) if self.size else time.time()
+        else:
+            self.size = 0
+            self.opened = time.time()
+        self.flushed = time.monotonic()
+        if compress:
+            self.namer = lambda name: name + ".gz"
+            self.rotator = geoNmeaLogHandler.gzipRotate
+    
+    @staticmethod
+    def gzipRotate(source, dest):
+        with open(source, 'rb') as src, gzip.open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(source)
+    
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=NMEA_LOG_BUFFER, encoding=self.encoding)
+    
+    def shouldRollover(self, record):
+        # size is counted here, seeking the file would flush the buffer
+        if self.backupCount <= 0 or self.size == 0:
+            return False
+        if self.maxBytes > 0 and self.size >= self.maxBytes:
+            return True
+        return self.maxAge > 0 and time.time() - self.opened >= self.maxAge
+    
+    def doRollover(self):
+        # nmea.txt.1[.gz] is the newest closed segment
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        for i in range(self.backupCount - 1, 0, -1):
+            sfn = self.rotation_filename("%s.%d" % (self.baseFilename, i))
+            dfn = self.rotation_filename("%s.%d" % (self.baseFilename, i + 1))
+            if os.path.exists(sfn):
+                os.replace(sfn, dfn)
+        self.rotate(self.baseFilename, self.rotation_filename(self.baseFilename + ".1"))
+        self.size = 0
+        self.opened = time.time()
+    
+    def emit(self, record):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            msg = self.format(record) + self.terminator
+            self.stream.write(msg)
+            self.size += len(msg)
+            now = time.monotonic()
+            if now - self.flushed >= NMEA_LOG_FLUSH_S:
+                self.stream.flush()
+                self.flushed = now
+        except Exception:
+            self.handleError(record)
 
-        return ("%s%s%s%s%s%s" % (xfc, yfc, xsc, ysc,xssc,yssc))
+class geoNmeaLogListener(logging.handlers.QueueListener):
+    # Flushes the handlers once no sentence has arrived for
+    # NMEA_LOG_FLUSH_S, the tail of a session reaches the disk even when
+    # the GPS goes quiet
+    def dequeue(self, block):
+        if not block:
+            return self.queue.get(False)
+        while True:
+            try:
+                return self.queue.get(True, NMEA_LOG_FLUSH_S)
+            except queue.Empty:
+                for handler in self.handlers:
+                    handler.flush()
 
 class geoBase():
     def __init__(self, opts, geoCB):
@@ -655,9 +2952,62 @@ class geoBase():
         # Typical GPS buadrate is 4800, override later if needed
         self.serial = serial.Serial(baudrate=4800, timeout=1)
                 
+        # Detector messages reach geoCB through the event bus on its own
+        # thread, latest state wins when it falls behind
+        self.bus = geoEventBus()
+        self.bus.subscribe(geoCB, "ui", policy="coalesce")
+        
         # Create geoDetector object
-        self.geoDet = arGeoDetector(self.serial, geoCB, self.logMain, self.logNMEA)
+        self.geoDet = arGeoDetector(self.serial, self.bus.publish, self.logMain, self.logNMEA)
+        self.fleet = [] # extra detector threads, one per GPS
+        self.geoDet.replay_source = opts.source
+        self.geoDet.index_engine = self.config.get('BOUNDARY','index', fallback="grid")
+        self.geoDet.cache_dir = self.appDirs.user_cache_dir
+        try:
+            self.geoDet.raster_res = float(self.config.get('BOUNDARY','raster', fallback=0))
+        except ValueError:
+            print("Warning: invalid boundary raster resolution, raster disabled")
+        try:
+            self.geoDet.simplify_m = float(self.config.get('BOUNDARY','simplify', fallback=0))
+        except ValueError:
+            print("Warning: invalid boundary simplification tolerance, simplification disabled")
+        precision = self.config.get('GRID','precision', fallback="6")
+        if precision in ("6", "8", "10"):
+            self.geoDet.grid_precision = int(precision)
+        else:
+            print("Warning: invalid grid locator precision, using 6 characters")
 
+    def usePort(self, port):
+        # Network input specs swap the serial port for a geoNetPort
+        if port and "://" in port:
+            self.serial = geoNetPort(port)
+        else:
+            if isinstance(self.serial, geoNetPort):
+                self.serial = serial.Serial(baudrate=4800, timeout=1)
+            self.serial.port = port
+        self.geoDet.com = self.serial
+    
+    def startFleet(self, ports):
+        # One detector thread per GPS, each with its own port, fix state and
+        # watchdog, all sharing the boundary set loaded by geoDet
+        rate = int(self.config.get('SERIAL','rate', fallback=4800))
+        for port in ports:
+            if "://" in port:
+                com = geoNetPort(port)
+            else:
+                com = serial.Serial(baudrate=rate, timeout=1)
+                com.port = port
+            det = self.geoDet.clone(self.geoDet.msg_cb, port, com)
+            det.state = 1 # right to serial open
+            det.start()
+            self.fleet.append(det)
+    
+    def updateFleet(self):
+        # Fleet detectors switch to the boundaries and route geoDet has
+        # loaded before their next fix
+        for det in self.fleet:
+            det.shareBoundaries(self.geoDet)
+    
     def playSound(self, msg):
         if os.name == 'nt':
             if msg == geoMsg.GRID:
@@ -691,19 +3041,30 @@ class geoBase():
         # NMEA log
         try:
             formatter = logging.Formatter('%(message)s')
-            handler = logging.FileHandler(self.nmeaFile)
-            handler.setFormatter(formatter)
+            self.nmeaHandler = geoNmeaLogHandler(self.nmeaFile)
+            self.nmeaHandler.setFormatter(formatter)
+            
+            # the detector threads only queue sentences, disk writes happen
+            # on the listener thread
+            nmeaQueue = queue.SimpleQueue()
+            self.nmeaListener = geoNmeaLogListener(nmeaQueue, self.nmeaHandler)
+            self.nmeaListener.start()
         
             self.logNMEA = logging.getLogger("nmea")
             self.logNMEA.setLevel(logging.INFO)
-            self.logNMEA.addHandler(handler)
+            self.logNMEA.addHandler(logging.handlers.QueueHandler(nmeaQueue))
         except:
             print("Error: Unable to initialize NMEA log file! [%s]" % self.nmeaFile)
             exit(1)
 
+    def closeLogs(self):
+        # Write out queued and buffered NMEA sentences
+        self.nmeaListener.stop()
+        self.nmeaHandler.close()
+
     def initSettings(self):
         # Create sections
-        sects = ["GUI", "BOUNDARY", "SERIAL", "ALERTS"]
+        sects = ["GUI", "BOUNDARY", "SERIAL", "ALERTS", "GRID"]
         for sect in sects:
             if not self.config.has_section(sect):
                 self.config.add_section(sect)
@@ -734,6 +3095,31 @@ class geoBase():
             else:
                 self.config.set('BOUNDARY','file', opts.bndfile)
         
+        if opts.index:
+            if opts.index not in ("grid", "rtree"):
+                print ("Error: unknown boundary index engine [%s]\n" % opts.index)
+                parser.print_help()
+                exit(1)
+            self.config.set('BOUNDARY','index', opts.index)
+        
+        if opts.raster is not None:
+            self.config.set('BOUNDARY','raster', "%g" % opts.raster)
+        
+        if opts.simplify is not None:
+            self.config.set('BOUNDARY','simplify', "%g" % opts.simplify)
+        
+        if opts.precision is not None:
+            if opts.precision not in (6, 8, 10):
+                print ("Error: grid locator precision must be 6, 8 or 10 [%d]\n" % opts.precision)
+                parser.print_help()
+                exit(1)
+            self.config.set('GRID','precision', "%d" % opts.precision)
+        
+        if opts.route and not os.path.isfile(opts.route):
+            print ("Error: route file not found [%s]\n" % opts.route)
+            parser.print_help()
+            exit(1)
+        
         if opts.nmeaFile:
             if not os.path.isfile(opts.nmeaFile):
                 print ("Error: NMEA data file not found [%s]\n" % opts.nmeaFile)
@@ -769,6 +3155,7 @@ class geoAboutDialog(wx.Frame):
 class geoFrame(wx.Frame, geoBase):
     def __init__(self, opts):
         wx.Frame.__init__(self, None, title="arGeoDetector by K3FRG", size=(500,150))
+        self.pending = {} # display updates waiting for the refresh timer
         geoBase.__init__(self, opts, self.geoCB)
         
         self.is_serial_configured = 0
@@ -785,6 +3172,11 @@ class geoFrame(wx.Frame, geoBase):
         self.CreateControls()
         self.Bind(wx.EVT_CLOSE, self.OnClose)
         
+        # geoCB only records updates, the timer shows them at a fixed rate
+        self.tmr_refresh = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnRefresh, self.tmr_refresh)
+        self.tmr_refresh.Start(GUI_REFRESH_MS)
+        
         self.geoDet.start()
         self.InitGUI()
         self.Show(True)
@@ -805,14 +3197,17 @@ class geoFrame(wx.Frame, geoBase):
 
         self.stat_time = ""
         self.stat_gps = ""
+        self.stat_next = {}
         bnd = self.config.get('BOUNDARY','file', fallback=None)
         if bnd:
             self.geoDet.loadBoundaries(bnd)
+        if self.opts.route:
+            self.geoDet.loadRoute(self.opts.route)
 
         try:
             port = self.config.get('SERIAL','port')
             rate = self.config.get('SERIAL','rate')
-            self.serial.port = port
+            self.usePort(port)
             self.serial.baudrate = rate
             self.is_serial_configured = 1
         except:
@@ -852,6 +3247,8 @@ class geoFrame(wx.Frame, geoBase):
         toolmenu = wx.Menu()
         self.menuToolReplay = toolmenu.Append(wx.ID_ANY, "Replay NMEA GPS log"," Replay captured or generated NMEA format GPS log")
         self.Bind(wx.EVT_MENU, self.OnToolReplay, self.menuToolReplay)
+        self.menuToolRoute = toolmenu.Append(wx.ID_ANY, "Load planned route"," Precompute county/city and grid crossings along a GPX, KML or NMEA route")
+        self.Bind(wx.EVT_MENU, self.OnToolRoute, self.menuToolRoute)
 
         helpmenu = wx.Menu()
         self.menuAboutLogs = helpmenu.Append(wx.ID_ANY, "About", " Open about dialog")
@@ -906,6 +3303,7 @@ class geoFrame(wx.Frame, geoBase):
             pass
         
         # cancel notification timers if active
+        self.tmr_refresh.Stop()
         if self.tmr_grid:
             self.tmr_grid.cancel()
         if self.tmr_cnty:
@@ -916,6 +3314,9 @@ class geoFrame(wx.Frame, geoBase):
             print ("stopping serial thread")
             self.geoDet.stop()
             self.geoDet.join()
+        self.geoDet.log(self.bus.report(), 0)
+        self.bus.close()
+        self.closeLogs()
         self.Destroy()
         
     def OnMenu(self, event):
@@ -938,6 +3339,9 @@ class geoFrame(wx.Frame, geoBase):
         if self.serial.is_open:
             return
 
+        if isinstance(self.serial, geoNetPort):
+            # the dialog configures a serial port in place of the network input
+            self.usePort(None)
         self.UpdateStatus("Launching serial configuration dialog...")
         dlg = SerialConfigDialog(self, -1, "", serial=self.serial, show=1)
         with self.geoDet.lock:
@@ -973,6 +3377,7 @@ class geoFrame(wx.Frame, geoBase):
                 pass
             self.config.set('BOUNDARY','file',file)
             self.geoDet.loadBoundaries(file)
+            self.updateFleet()
         
     def OnCopyGrid(self, event):
         if not wx.TheClipboard.IsOpened():
@@ -995,8 +3400,6 @@ class geoFrame(wx.Frame, geoBase):
         if self.serial.is_open:
             self.geoDet.closePort()
             self.reopen = 1
-            while self.serial.is_open:
-                time.sleep(0.1)
 
         dlg = wx.FileDialog(self, "Select NMEA GPS Log", wildcard="Log File (*.txt;*.log)|*.txt;*.log|All Files (*.*)|*.*")
         dlg.SetDirectory(self.appDirs.user_config_dir)
@@ -1009,6 +3412,13 @@ class geoFrame(wx.Frame, geoBase):
             if self.reopen:
                 self.geoDet.openPort()
 
+    def OnToolRoute(self, event):
+        dlg = wx.FileDialog(self, "Select Planned Route", wildcard="Route File (*.gpx;*.kml;*.txt;*.log)|*.gpx;*.kml;*.txt;*.log|All Files (*.*)|*.*")
+        dlg.SetDirectory(self.appDirs.user_config_dir)
+        if dlg.ShowModal() == wx.ID_OK:
+            self.geoDet.loadRoute(os.path.join(dlg.GetDirectory(),dlg.GetFilename()))
+            self.updateFleet()
+    
     def OnReplayComplete(self):
         if self.reopen:
             self.geoDet.openPort()
@@ -1097,27 +3507,56 @@ class geoFrame(wx.Frame, geoBase):
     def UpdateStatus(self, s):
         self.SetStatusText(s)
 
+    def OnRefresh(self, event):
+        # Show the latest pending value of each display, values arriving
+        # while this runs stay pending for the next tick
+        while True:
+            try:
+                (k,s) = self.pending.popitem()
+            except KeyError:
+                break
+            if k == geoMsg.GRID:
+                self.UpdateGrid(s)
+            elif k == geoMsg.CNTY:
+                self.UpdateCnty(s)
+            else:
+                self.UpdateStatus(s)
+    
     def geoCB(self, msg):
         #print("CB>")
+        # Runs on the bus-ui delivery thread, never the GUI thread.  Only
+        # plain dict updates of pending happen here, displays are updated
+        # by OnRefresh.  OnReplayComplete runs here too, openPort is safe
+        # from any thread.
         (t,s) = msg
         if t == geoMsg.GRID:
             self.geo_grid = s
-            wx.CallAfter(self.UpdateGrid,s)
+            self.pending[geoMsg.GRID] = s
         elif t == geoMsg.CNTY:
             (n,a) = s
             self.geo_cnty = a
             if self.gui_small:
-                wx.CallAfter(self.UpdateCnty,"{}/{}".format(a,n))
+                self.pending[geoMsg.CNTY] = "{}/{}".format(a,n)
             else:
-                wx.CallAfter(self.UpdateCnty,"{} ({})".format(n,a))
+                self.pending[geoMsg.CNTY] = "{} ({})".format(n,a)
         elif t == geoMsg.STAT:
-            wx.CallAfter(self.UpdateStatus,s)
+            self.pending[geoMsg.STAT] = s
         elif t == geoMsg.TIME:
             self.stat_time = s
-            wx.CallAfter(self.UpdateStatus,"{} - {}".format(self.stat_time, self.stat_gps))
+            self.pending[geoMsg.STAT] = "{} - {}".format(self.stat_time, self.stat_gps)
         elif t == geoMsg.GPS:
             self.stat_gps = s
-            wx.CallAfter(self.UpdateStatus,"{} - {}".format(self.stat_time, self.stat_gps))
+            self.pending[geoMsg.STAT] = "{} - {}".format(self.stat_time, self.stat_gps)
+        elif t == geoMsg.NEXT:
+            (ctype, dist, eta, name) = s
+            if dist is None:
+                self.stat_next.pop(ctype, None)
+            else:
+                self.stat_next[ctype] = "{} {:.1f} mi".format(name, dist / 1609.344)
+                if eta is not None:
+                    self.stat_next[ctype] += " {:d}:{:02d}".format(int(eta) // 60, int(eta) % 60)
+            nxt = " | ".join(self.stat_next[c] for c in (geoMsg.CNTY, geoMsg.GRID) if c in self.stat_next)
+            self.pending[geoMsg.STAT] = "{} - {} - {}".format(self.stat_time, self.stat_gps, nxt)
         elif t == geoMsg.NOTIF:
             wx.CallAfter(self.ChangeAlert, s)
         elif t == geoMsg.REPLAY:
@@ -1132,19 +3571,39 @@ class geoCLI(geoBase):
         bnd = self.config.get('BOUNDARY','file', fallback=None)
         if bnd:
             self.geoDet.loadBoundaries(bnd)
+        if opts.route:
+            self.geoDet.loadRoute(opts.route)
         
 
     def sigint(self, sig, frame):
-        self.geoDet._do_exit = 1;
+        for det in [self.geoDet] + self.fleet:
+            det.stop()
 
     def run(self):
         # check for replay mode
-        if self.mode == 1:
+        if self.mode == 1 and self.opts.output:
+            self.geoDet.classifyFile(self.replayFile, self.opts.output)
+        elif self.mode == 1:
             self.geoDet.replayFile(self.replayFile)
+        elif self.opts.fleet:
+            signal.signal(signal.SIGINT, self.sigint)
+            self.geoDet.mode = 1 # threads end once their port gives up
+            self.startFleet(self.opts.fleet)
+            for det in self.fleet:
+                while det.is_alive():
+                    det.join(1)
+        elif self.opts.inputs:
+            # any number of inputs on one event loop
+            engine = geoAsyncDetector(self.geoDet, int(self.config.get('SERIAL','rate', fallback=4800)))
+            engine.addSink(lambda spec, msg: self.bus.publish(msg))
+            try:
+                asyncio.run(engine.run(self.opts.inputs))
+            except KeyboardInterrupt:
+                pass
         else:          
             signal.signal(signal.SIGINT, self.sigint)
             try:
-                self.serial.port = self.config.get('SERIAL','port')
+                self.usePort(self.config.get('SERIAL','port'))
                 self.serial.buadrate = self.config.get('SERIAL','rate', fallback=4800)
             except:
                 print("Error: Serial port parameters not provided! Configure through GUI mode or pass --port parameter.")
@@ -1157,6 +3616,10 @@ class geoCLI(geoBase):
             self.geoDet.state = 1 # skip idle and right to serial open
             self.geoDet.run()
             
+        self.geoDet.log(self.bus.report(), 0)
+        self.bus.close()
+        self.closeLogs()
+        
         # store any new settings from cli
         self.writeSettings()
         
@@ -1181,13 +3644,31 @@ if __name__ == '__main__':
                     action="store_true", default=False,
                     help="Run in command line mode")
     parser.add_option("-p", "--port", dest="port",
-                    help="GPS serial port")
+                    help="GPS serial port, or tcp://host:port, gpsd://host:port, tcp-listen://[host]:port or udp://[host]:port")
     parser.add_option("-r", "--rate", dest="rate",type="int",
                     help="GPS serial rate")
     parser.add_option("-n", "--nmea", dest="nmeaFile",
                     help="NMEA data file for replay processing")
+    parser.add_option("-o", "--output", dest="output",
+                    help="Classify the NMEA data file into this CSV file instead of replaying it")
     parser.add_option("-b", "--boundary", dest="bndfile",
                     help="Geographic boundary kml data file")
+    parser.add_option("-i", "--index", dest="index",
+                    help="Boundary lookup engine, grid or rtree")
+    parser.add_option("--raster", dest="raster", type="float",
+                    help="Boundary raster cell size in degrees, 0 disables")
+    parser.add_option("--simplify", dest="simplify", type="float",
+                    help="Boundary simplification tolerance in meters, 0 disables")
+    parser.add_option("--fleet", dest="fleet", action="append",
+                    help="GPS serial port or network input tracked by its own detector thread in command line mode, may be repeated")
+    parser.add_option("--input", dest="inputs", action="append",
+                    help="GPS input processed on the asyncio engine in command line mode, a serial device, tcp://host:port, gpsd://host:port, tcp-listen://[host]:port or udp://[host]:port, may be repeated")
+    parser.add_option("-g", "--precision", dest="precision", type="int",
+                    help="Grid locator length, 6, 8 or 10 characters")
+    parser.add_option("--route", dest="route",
+                    help="Planned route (GPX, KML or NMEA) to precompute crossings along")
+    parser.add_option("--source", dest="source",
+                    help="Receiver to read from an NMEA log shared by several inputs, as tagged in [source], for replay, classification and routes")
     #parser.add_option("-l", "--log", dest="logFile",
     #                 help="Log filename root, creates filename.log and filename.nmea")
     #parser.add_option("-v", "--verbose", dest="verbose",
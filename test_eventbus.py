@@ -0,0 +1,62 @@
+import threading
+import time
+import unittest
+
+import arGeoDetector as agd
+from arGeoDetector import geoMsg
+
+
+class testEventBus(unittest.TestCase):
+    def flood(self, policy):
+        # a blocked subscriber gets an alert, a replay end and far more
+        # status lines than its queue holds
+        got = []
+        gate = threading.Event()
+        bus = agd.geoEventBus()
+        def cb(msg):
+            gate.wait()
+            got.append(msg)
+        sub = bus.subscribe(cb, "test", maxlen=8, policy=policy)
+        bus.publish((geoMsg.STAT, "busy"))
+        time.sleep(0.05)
+        bus.publish((geoMsg.NOTIF, 2))
+        for i in range(20):
+            bus.publish((geoMsg.STAT, "a%d" % i))
+        bus.publish((geoMsg.REPLAY, 0))
+        for i in range(20):
+            bus.publish((geoMsg.STAT, "b%d" % i))
+        gate.set()
+        bus.close()
+        return (got, sub)
+
+    def testCoalesce(self):
+        (got, sub) = self.flood("coalesce")
+        self.assertIn((geoMsg.NOTIF, 2), got)
+        self.assertIn((geoMsg.REPLAY, 0), got)
+        self.assertEqual([s for (t,s) in got if t == geoMsg.STAT], ["busy", "b19"])
+        self.assertEqual(sub.dropped, 0)
+
+    def testDropOldest(self):
+        (got, sub) = self.flood("drop-oldest")
+        self.assertIn((geoMsg.NOTIF, 2), got)
+        self.assertIn((geoMsg.REPLAY, 0), got)
+        self.assertEqual(got[-1], (geoMsg.STAT, "b19"))
+        self.assertGreater(sub.dropped, 0)
+
+    def testStateCoalesce(self):
+        got = []
+        gate = threading.Event()
+        bus = agd.geoEventBus()
+        bus.subscribe(lambda msg: (gate.wait(), got.append(msg)), "test", policy="coalesce")
+        bus.publish((geoMsg.STAT, "busy"))
+        time.sleep(0.05)
+        for grid in ("FM18", "FM19", "FM18"):
+            bus.publish((geoMsg.GRID, grid))
+        bus.publish((geoMsg.CNTY, ("Fairfax", "FFX")))
+        gate.set()
+        bus.close()
+        self.assertEqual(got[1:], [(geoMsg.GRID, "FM18"), (geoMsg.CNTY, ("Fairfax", "FFX"))])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+import arGeoDetector as agd
+from arGeoDetector import geoMsg
+
+RMC_STOPPED = "$GPRMC,123519,A,4807.038,N,01131.000,E,000.0,084.4,230394,003.1,W*6E"
+
+
+class testGrid(unittest.TestCase):
+    def testSize(self):
+        for precision in (6, 8, 10):
+            (grid, (x0, y0, x1, y1)) = agd.arGeoDetector.gridLocator((11.517, 48.117), precision)
+            self.assertEqual(len(grid), precision)
+            (w, h) = agd.arGeoDetector.gridSize(precision)
+            self.assertAlmostEqual(x1 - x0, w)
+            self.assertAlmostEqual(y1 - y0, h)
+
+    def testNearestGridEdge(self):
+        det = agd.arGeoDetector(None, lambda msg: None, 0, None)
+        for precision in (6, 8, 10):
+            det.grid_precision = precision
+            (_, (x0, y0, x1, y1)) = det.gridLocator((11.517, 48.117), precision)
+            xy = ((x0 + x1) / 2, y0 + (y1 - y0) / 10)
+            (d, across) = det.nearestGridEdge(xy)
+            self.assertAlmostEqual(d, (y1 - y0) / 10 * agd.DEG_M, places=3)
+            self.assertEqual(across, det.gridLocator((xy[0], y0 - (y1 - y0) / 2), precision)[0])
+
+    def testStopped(self):
+        # without a heading the nearest line of the configured locator is shown
+        msgs = []
+        det = agd.arGeoDetector(None, msgs.append, 0, None)
+        det.grid_precision = 8
+        det.updateNmeaRmcMotion(agd.geoNmea.parse(RMC_STOPPED))
+        (ctype, d, eta, grid) = [s for (t, s) in msgs if t == geoMsg.NEXT][-1]
+        self.assertEqual((ctype, eta, len(grid)), (geoMsg.GRID, None, 8))
+        self.assertGreaterEqual(d, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
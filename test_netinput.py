@@ -0,0 +1,333 @@
+import asyncio
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from functools import reduce
+
+import arGeoDetector as agd
+
+
+def nmea(body):
+    csum = reduce(lambda c, ch: c ^ ord(ch), body, 0)
+    return ("$%s*%02X\r\n" % (body, csum)).encode()
+
+RMC = nmea("GPRMC,123519,A,4807.038,N,01131.000,E,022.4,084.4,230394,003.1,W")
+GGA = nmea("GPGGA,123520,4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,")
+
+KML = """<?xml version="1.0" encoding="UTF-8"?>
+<kml xmlns="http://earth.google.com/kml/2.1"><Document>
+<Placemark><name>Munich=MUC 1</name><Polygon><outerBoundaryIs><LinearRing>
+<coordinates>11,48 12,48 12,49 11,49 11,48</coordinates>
+</LinearRing></outerBoundaryIs></Polygon></Placemark>
+</Document></kml>
+"""
+
+
+class nmeaSink():
+    # stands in for the NMEA logger
+    def __init__(self):
+        self.lines = []
+
+    def info(self, line):
+        self.lines.append(line)
+
+
+def freePort(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class closingServer():
+    # accepts every connection and closes it straight away, optionally
+    # after sending data
+    def __init__(self, data=b''):
+        self.data = data
+        self.accepts = 0
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(16)
+        self.sock.settimeout(0.1)
+        self.port = self.sock.getsockname()[1]
+        self.done = False
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while not self.done:
+            try:
+                (client, _) = self.sock.accept()
+            except socket.timeout:
+                continue
+            self.accepts += 1
+            if self.data:
+                client.sendall(self.data)
+            client.close()
+
+    def close(self):
+        self.done = True
+        self.thread.join()
+        self.sock.close()
+
+
+class fakeGpsd():
+    # answers like gpsd, NMEA only after the client asked for it with WATCH
+    VERSION = b'{"class":"VERSION","release":"3.25","proto_major":3,"proto_minor":15}\r\n'
+    REPORT = b'{"class":"DEVICES","devices":[{"path":"/dev/ttyUSB0"}]}\r\n'
+
+    def __init__(self):
+        self.watch = b''
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen(4)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        (client, _) = self.sock.accept()
+        with client:
+            client.sendall(self.VERSION)
+            while not self.watch.endswith(b'\n'):
+                data = client.recv(256)
+                if not data:
+                    return
+                self.watch += data
+            client.sendall(self.REPORT + RMC + self.REPORT + RMC)
+            time.sleep(1)
+
+    def close(self):
+        self.sock.close()
+
+
+class testNetPort(unittest.TestCase):
+    def readAll(self, port, count):
+        data = b''
+        deadline = time.monotonic() + 2
+        while len(data) < count and time.monotonic() < deadline:
+            data += port.read()
+        return data
+
+    def testParseSpec(self):
+        self.assertEqual(agd.geoNetPort.parseSpec("tcp://:10110"), ("tcp", "localhost", 10110))
+        self.assertEqual(agd.geoNetPort.parseSpec("gpsd://:2947"), ("gpsd", "localhost", 2947))
+        self.assertEqual(agd.geoNetPort.parseSpec("tcp-listen://[::1]:10110"), ("tcp-listen", "::1", 10110))
+        self.assertEqual(agd.geoNetPort.parseSpec("udp://:10110"), ("udp", "", 10110))
+        with self.assertRaises(ValueError):
+            agd.geoNetPort.parseSpec("/dev/ttyUSB0")
+
+    def testTcp(self):
+        server = closingServer(RMC * 3)
+        port = agd.geoNetPort("tcp://127.0.0.1:%d" % server.port)
+        try:
+            port.open()
+            self.assertEqual(self.readAll(port, len(RMC) * 3), RMC * 3)
+            with self.assertRaises(agd.serial.serialutil.SerialException):
+                while True:
+                    port.read()
+        finally:
+            port.close()
+            server.close()
+
+    def testGpsd(self):
+        gpsd = fakeGpsd()
+        port = agd.geoNetPort("gpsd://127.0.0.1:%d" % gpsd.port)
+        try:
+            port.open()
+            buf = bytearray(self.readAll(port, len(fakeGpsd.VERSION) + 2 * (len(fakeGpsd.REPORT) + len(RMC))))
+            lines = agd.deque()
+            agd.geoNmea.frame(buf, lines)
+            self.assertEqual(list(lines), [RMC.decode().strip()] * 2)
+            self.assertEqual(gpsd.watch, agd.GPSD_WATCH)
+        finally:
+            port.close()
+            gpsd.close()
+
+    def testTcpListen(self):
+        tcp_port = freePort()
+        port = agd.geoNetPort("tcp-listen://127.0.0.1:%d" % tcp_port)
+        port.open()
+        try:
+            with socket.create_connection(("127.0.0.1", tcp_port)) as client:
+                client.sendall(RMC)
+                self.assertEqual(self.readAll(port, len(RMC)), RMC)
+        finally:
+            port.close()
+
+    def testUdp(self):
+        udp_port = freePort(socket.SOCK_DGRAM)
+        port = agd.geoNetPort("udp://127.0.0.1:%d" % udp_port)
+        port.open()
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+                client.sendto(RMC.rstrip(), ("127.0.0.1", udp_port))
+                client.sendto(RMC, ("127.0.0.1", udp_port))
+            self.assertEqual(self.readAll(port, len(RMC) * 2), RMC * 2)
+        finally:
+            port.close()
+
+    def testCancelRead(self):
+        port = agd.geoNetPort("udp://127.0.0.1:%d" % freePort(socket.SOCK_DGRAM), timeout=5)
+        port.open()
+        try:
+            threading.Timer(0.1, port.cancel_read).start()
+            start = time.monotonic()
+            self.assertEqual(port.read(), b'')
+            self.assertLess(time.monotonic() - start, 1)
+        finally:
+            port.close()
+
+
+class testThreadInput(unittest.TestCase):
+    def runDetector(self, spec, seconds):
+        sink = nmeaSink()
+        det = agd.arGeoDetector(agd.geoNetPort(spec), lambda msg: None, 0, sink)
+        det.state = 1
+        det.start()
+        time.sleep(seconds)
+        det.stop()
+        det.join(5)
+        self.assertFalse(det.is_alive())
+        return sink.lines
+
+    def testReceive(self):
+        server = closingServer(RMC * 5)
+        try:
+            lines = self.runDetector("tcp://127.0.0.1:%d" % server.port, 0.5)
+        finally:
+            server.close()
+        self.assertIn(RMC.decode().strip(), lines)
+
+    def testGpsd(self):
+        gpsd = fakeGpsd()
+        try:
+            lines = self.runDetector("gpsd://127.0.0.1:%d" % gpsd.port, 0.5)
+        finally:
+            gpsd.close()
+        self.assertEqual(lines, [RMC.decode().strip()] * 2)
+
+    def testReconnectBackoff(self):
+        # a peer closing before sending anything is retried with a growing delay
+        server = closingServer()
+        try:
+            self.runDetector("tcp://127.0.0.1:%d" % server.port, 1.5)
+        finally:
+            server.close()
+        self.assertGreaterEqual(server.accepts, 2)
+        self.assertLessEqual(server.accepts, 5)
+
+
+class testAsyncInput(unittest.TestCase):
+    def runEngine(self, specs, seconds, setup=None):
+        sink = nmeaSink()
+        engine = agd.geoAsyncDetector(agd.arGeoDetector(None, lambda msg: None, 0, sink))
+        async def main():
+            task = asyncio.create_task(engine.run(specs))
+            if setup:
+                await setup()
+            await asyncio.sleep(seconds)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        asyncio.run(main())
+        return sink.lines
+
+    def testInputs(self):
+        (listen_port, udp_port) = (freePort(), freePort(socket.SOCK_DGRAM))
+        async def send():
+            await asyncio.sleep(0.2)
+            (_, writer) = await asyncio.open_connection("127.0.0.1", listen_port)
+            writer.write(RMC)
+            await writer.drain()
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+                client.sendto(RMC.rstrip(), ("127.0.0.1", udp_port))
+            writer.close()
+        server = closingServer(RMC)
+        try:
+            lines = self.runEngine(["tcp://127.0.0.1:%d" % server.port,
+                                    "tcp-listen://127.0.0.1:%d" % listen_port,
+                                    "udp://127.0.0.1:%d" % udp_port], 0.6, send)
+        finally:
+            server.close()
+        self.assertGreaterEqual(len([l for l in lines if l.endswith("] " + RMC.decode().strip())]), 3)
+
+    def testGpsd(self):
+        gpsd = fakeGpsd()
+        spec = "gpsd://127.0.0.1:%d" % gpsd.port
+        try:
+            lines = self.runEngine([spec], 0.5)
+        finally:
+            gpsd.close()
+        self.assertEqual(lines, ["[%s] %s" % (spec, RMC.decode().strip())] * 2)
+
+    def runSynced(self, spec, seconds, setup=None):
+        # messages of an engine with boundaries around the test fixes
+        msgs = []
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "test.kml"), "w") as fp:
+                fp.write(KML)
+            det = agd.arGeoDetector(None, lambda msg: None, 0, nmeaSink())
+            det.cache_dir = None
+            det.loadBoundaries(os.path.join(tmp, "test.kml"))
+        engine = agd.geoAsyncDetector(det)
+        engine.addSink(lambda spec, msg: msgs.append(msg))
+        async def main():
+            task = asyncio.create_task(engine.run([spec]))
+            if setup:
+                await setup()
+            await asyncio.sleep(seconds)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        asyncio.run(main())
+        return msgs
+
+    def assertSynced(self, msgs):
+        # the fix ahead of the first RMC is skipped, the one after it is located
+        kinds = [kind for (kind, _) in msgs]
+        self.assertIn(agd.geoMsg.GRID, kinds)
+        self.assertEqual(msgs[kinds.index(agd.geoMsg.TIME)], (agd.geoMsg.TIME, "2094/03/23 12:35:19 UTC"))
+        self.assertLess(kinds.index(agd.geoMsg.TIME), kinds.index(agd.geoMsg.GRID))
+        self.assertIn((agd.geoMsg.CNTY, ("Munich", "MUC")), msgs)
+        return kinds
+
+    @unittest.skipUnless(hasattr(os, "openpty"), "needs a pty")
+    def testSerialSync(self):
+        (master, slave) = os.openpty()
+        async def send():
+            await asyncio.sleep(0.2)
+            os.write(master, GGA + RMC + GGA)
+        try:
+            msgs = self.runSynced(os.ttyname(slave), 0.5, send)
+        finally:
+            os.close(master)
+            os.close(slave)
+        self.assertEqual(self.assertSynced(msgs).count(agd.geoMsg.GRID), 1)
+
+    def testTcpSync(self):
+        server = closingServer(GGA + RMC + GGA)
+        try:
+            msgs = self.runSynced("tcp://127.0.0.1:%d" % server.port, 0.5)
+        finally:
+            server.close()
+        self.assertSynced(msgs)
+
+    def testReconnectBackoff(self):
+        server = closingServer()
+        try:
+            self.runEngine(["tcp://127.0.0.1:%d" % server.port], 1.5)
+        finally:
+            server.close()
+        self.assertGreaterEqual(server.accepts, 2)
+        self.assertLessEqual(server.accepts, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from collections import deque
+
+import arGeoDetector as agd
+
+GGA = "$GPGGA,123519,4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,*47"
+RMC = "$GPRMC,123519,A,4807.038,N,01131.000,E,022.4,084.4,230394,003.1,W*6A"
+
+
+def withChecksum(body):
+    return "$%s*%02X" % (body, agd.geoNmea.checksum(body))
+
+
+class testParse(unittest.TestCase):
+    def testGGA(self):
+        rec = agd.geoNmea.parse(GGA)
+        self.assertIs(type(rec), agd.geoNmeaGGA)
+        self.assertEqual((rec.talker, rec.lat, rec.lon_d, rec.quality), ("GP", "4807.038", "E", "1"))
+
+    def testRMC(self):
+        rec = agd.geoNmea.parse(RMC + "\r\n")
+        self.assertIs(type(rec), agd.geoNmeaRMC)
+        self.assertEqual((rec.status, rec.date), ("A", "230394"))
+
+    def testTalkers(self):
+        for talker in agd.geoNmea.TALKERS:
+            rec = agd.geoNmea.parse(withChecksum(talker + GGA[3:GGA.index('*')]))
+            self.assertEqual(rec.talker, talker)
+        self.assertIsNone(agd.geoNmea.parse(withChecksum("XX" + GGA[3:GGA.index('*')])))
+
+    def testBadChecksum(self):
+        self.assertIsNone(agd.geoNmea.parse(GGA[:-2] + "48"))
+        self.assertIsNone(agd.geoNmea.parse(GGA[:-1]))
+        self.assertIsNone(agd.geoNmea.parse(GGA[:-2] + "zz"))
+
+    def testNoChecksum(self):
+        line = GGA[:GGA.index('*')]
+        self.assertIsNone(agd.geoNmea.parse(line))
+        self.assertIs(type(agd.geoNmea.parse(line, strict=False)), agd.geoNmeaGGA)
+
+    def testTruncated(self):
+        # cut at a field boundary, the longitude is short but every field
+        # the record needs is still there
+        line = "$GPGGA,123519,4807.038,N,011,E,1"
+        self.assertIsNone(agd.geoNmea.parse(line))
+        self.assertIsNone(agd.geoNmea.parse(GGA[:30]))
+        self.assertIsNone(agd.geoNmea.parse(RMC[:40], strict=False))
+
+    def testLogged(self):
+        line = "[udp://:10110] " + GGA
+        self.assertIsNone(agd.geoNmea.parseLogged(line))
+        self.assertIs(type(agd.geoNmea.parseLogged(line, "udp://:10110")), agd.geoNmeaGGA)
+        self.assertIs(type(agd.geoNmea.parseLogged(GGA)), agd.geoNmeaGGA)
+        self.assertIsNone(agd.geoNmea.parseLogged(GGA, "udp://:10110"))
+
+    def testUnsupported(self):
+        self.assertIsNone(agd.geoNmea.parse(withChecksum("GPGSV,3,1,11")))
+        self.assertIsNone(agd.geoNmea.parse(""))
+        self.assertIsNone(agd.geoNmea.parse("GPGGA" + GGA))
+
+
+class testFrame(unittest.TestCase):
+    def testPartialLine(self):
+        buf = bytearray((GGA + "\r\n" + RMC[:20]).encode())
+        lines = deque()
+        self.assertEqual(agd.geoNmea.frame(buf, lines), 0)
+        self.assertEqual(list(lines), [GGA])
+        buf += (RMC[20:] + "\r\n").encode()
+        agd.geoNmea.frame(buf, lines)
+        self.assertEqual(list(lines), [GGA, RMC])
+        self.assertEqual(buf, b'')
+
+    def testUndecodable(self):
+        buf = bytearray(b'\xff\xfe\r\n' + (GGA + "\r\n").encode())
+        lines = deque()
+        self.assertEqual(agd.geoNmea.frame(buf, lines), 1)
+        self.assertEqual(list(lines), [GGA])
+
+
+if __name__ == "__main__":
+    unittest.main()